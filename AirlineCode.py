@@ -2,32 +2,1945 @@ import tkinter as tk # Import the Tkinter library to create the GUI
 from tkinter import messagebox # For showing popup messages
 import json # To save and load booking data
 import os # To check if the bookings file exists
+import zlib # Stable hash for picking a booking shard
+import threading # Per-shard locks and the reservation lock
+import time # Expiry times for seat holds
+import itertools # Numbers for seat holds
+import heapq # Top results for queries and the metrics collector
+import bisect # Searching the departure-time index and keeping waitlists in order
+import functools # Keeps method names when wrapping them for metrics
+import socket # Sending metrics to a collector
+import cProfile # Profiling GUI handlers
+import pstats # Reading profiler results
+import io # Text buffer for profiler summaries
+import logging # Slow-event log
+import logging.handlers # Rotating log file for slow events
+import argparse # Command line options
+import shutil # Copying data files for headless profiling
+import tempfile # Scratch folder for headless profiling
+import gzip # Compressed archive segments
+import mmap # Memory-mapped binary booking store
+import struct # Fixed-width records in the binary booking store
+import array # Compact int columns for encoded bookings
+import csv # Passenger manifests
+import zipfile # Combined manifest archive
+try:
+   import fcntl # File locks between processes (not available on Windows)
+except ImportError:
+   fcntl = None
+from datetime import datetime, timedelta # Reading flight departure times, stepping through schedule days
+from collections import OrderedDict, namedtuple # LRU order for caches, small event types
+from collections.abc import MutableMapping # Binary booking store acts like the bookings dictionary
+from concurrent.futures import ThreadPoolExecutor # Writes several shards at the same time
+from contextlib import contextmanager # Lock that writes the booking shards once it is released
+
+DEFAULT_CAPACITY = 150 # Seats on a flight when none is given
+HOLD_TTL = 300 # Seconds a held seat is kept before it is released
+SNAPSHOT_INTERVAL = 300 # Seconds between automatic snapshots in the GUI
+DEFAULT_BASE_FARE = 120.0 # Economy fare before demand pricing, when a flight has none
+SCHEDULE_HORIZON = 14 # Days of scheduled departures offered for booking
+REPLICA_POLL = 1.0 # Seconds between checks of the mutation log by a following replica
+TRACE_FILE = "request_trace.jsonl" # Default file for recorded operations
+INTEGRITY_FILE = "integrity.json" # Checksums and problems from the last integrity check
+INTEGRITY_SEGMENTS = 64 # Flights and bookings are checked in this many groups (by flight code)
+TRACED_OPERATIONS = {"book_flight", "view_booking", "cancel_booking", "add_flight", "delete_flight", "cancel_flight",
+                     "reschedule_flight", "hold_seat", "confirm_hold", "release_hold", "expire_holds", "join_waitlist",
+                     "leave_waitlist", "add_schedule", "remove_schedule", "archive_departed", "reshard",
+                     "get_all_bookings_report", "get_flights_summary_report"} # What a trace records
 
 # Flight Class to store info about each flight
 class Flight:
-   def __init__(self, code, destination, date_time):
+   def __init__(self, code, destination, date_time, capacity=DEFAULT_CAPACITY, base_fare=DEFAULT_BASE_FARE):
        self.code = code # Flight code (like LA123)
        self.destination = destination # Where the flight is going
        self.date_time = date_time # When the flight is leaving
+       self.capacity = capacity # Number of seats that can be booked
+       self.base_fare = base_fare # Economy fare before demand pricing
+       self.fare_table = None # Precomputed fares (fare class -> days bucket), filled in by FareEngine
+       self.fare_load_bucket = None # Load factor bucket the fare table was built for
 
    def __str__(self):
        # This helps print the flight info in a readable way
        return f"{self.code}: {self.destination} at {self.date_time}"
 
+   def to_dict(self):
+       # Plain dictionary used when saving the flight
+       return {"code": self.code, "destination": self.destination, "date_time": self.date_time,
+               "capacity": self.capacity, "base_fare": self.base_fare}
+
+# Build a Flight from a saved dictionary (older files have no capacity or fare)
+def flight_from_dict(data):
+   return Flight(data["code"], data["destination"], data["date_time"], data.get("capacity", DEFAULT_CAPACITY),
+                 data.get("base_fare", DEFAULT_BASE_FARE))
+
+# Turn "YYYY-MM-DD HH:MM" (or just "YYYY-MM-DD") into a datetime, None if it can't be read
+def parse_departure(date_time):
+   for pattern in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+       try:
+           return datetime.strptime(date_time, pattern)
+       except (TypeError, ValueError):
+           continue
+   return None
+
+# Recurring departures stored as one rule, e.g. LA123 to Los Angeles daily at 10:00 from A to B.
+# Each departure gets the code "LA123-YYYYMMDD" and only becomes a real Flight once it is booked.
+class ScheduleRule:
+   def __init__(self, code, destination, time_of_day, start, end, weekdays=None, exceptions=(),
+                capacity=DEFAULT_CAPACITY, base_fare=DEFAULT_BASE_FARE):
+       self.code = code # Route code, the departures add the date to it
+       self.destination = destination
+       self.time_of_day = time_of_day # "HH:MM"
+       self.start = start # First date, "YYYY-MM-DD"
+       self.end = end # Last date, "YYYY-MM-DD"
+       self.weekdays = weekdays # Days it flies (0 = Monday), None for every day
+       self.exceptions = set(exceptions) # Dates it doesn't fly (holidays, deleted departures)
+       self.capacity = capacity
+       self.base_fare = base_fare
+
+   def __str__(self):
+       return f"{self.code}: {self.destination} at {self.time_of_day} from {self.start} to {self.end}"
+
+   def runs_on(self, day):
+       # day is a datetime at midnight
+       text = day.strftime("%Y-%m-%d")
+       return (self.start <= text <= self.end and text not in self.exceptions
+               and (self.weekdays is None or day.weekday() in self.weekdays))
+
+   def instance_code(self, day):
+       return f"{self.code}-{day:%Y%m%d}"
+
+   def flight_on(self, day):
+       return Flight(self.instance_code(day), self.destination, f"{day:%Y-%m-%d} {self.time_of_day}", self.capacity, self.base_fare)
+
+   def instances(self, start=None, end=None):
+       # Generator of the departures between two dates (datetimes), built one at a time
+       first = max(parse_departure(self.start), start or datetime.min)
+       last = min(parse_departure(self.end), end or datetime.max)
+       day = datetime(first.year, first.month, first.day)
+       while day <= last:
+           if self.runs_on(day):
+               yield self.flight_on(day)
+           day += timedelta(days=1)
+
+   def to_dict(self):
+       return {"code": self.code, "destination": self.destination, "time": self.time_of_day, "start": self.start,
+               "end": self.end, "weekdays": self.weekdays, "exceptions": sorted(self.exceptions),
+               "capacity": self.capacity, "base_fare": self.base_fare}
+
+def rule_from_dict(data):
+   return ScheduleRule(data["code"], data["destination"], data["time"], data["start"], data["end"], data.get("weekdays"),
+                       data.get("exceptions", ()), data.get("capacity", DEFAULT_CAPACITY), data.get("base_fare", DEFAULT_BASE_FARE))
+
+# Latency histogram with HDR-style buckets: every power of two is split into 8 equal
+# sub-buckets, so any value is recorded with at most ~12% error in constant memory
+class LatencyHistogram:
+   def __init__(self):
+       self.buckets = {} # Bucket upper bound in microseconds -> count
+       self.count = 0
+       self.total = 0.0 # Sum of all values in seconds
+       self.max = 0.0
+
+   def record(self, seconds):
+       micros = int(seconds * 1000000)
+       shift = max(micros.bit_length() - 4, 0) # Keep the top 4 bits of the value
+       upper = ((micros >> shift) + 1) << shift
+       self.buckets[upper] = self.buckets.get(upper, 0) + 1
+       self.count += 1
+       self.total += seconds
+       if seconds > self.max:
+           self.max = seconds
+
+   def percentile(self, percent):
+       # Upper bound (in seconds) of the bucket holding the given percentile
+       if not self.count:
+           return 0.0
+       wanted = self.count * percent / 100.0
+       seen = 0
+       for upper in sorted(self.buckets):
+           seen += self.buckets[upper]
+           if seen >= wanted:
+               return upper / 1000000.0
+       return self.max
+
+   def summary(self):
+       return {"count": self.count, "sum": self.total, "max": self.max,
+               "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99)}
+
+# Counters and latency histograms for the reservation system; does nothing while disabled
+class MetricsRegistry:
+   def __init__(self, enabled=False):
+       self.enabled = enabled # Checked first by every instrumented call
+       self.counters = {} # Name -> count
+       self.histograms = {} # Name -> LatencyHistogram
+
+   def increment(self, name, amount=1):
+       if self.enabled:
+           self.counters[name] = self.counters.get(name, 0) + amount
+
+   def observe(self, name, seconds):
+       if self.enabled:
+           histogram = self.histograms.get(name)
+           if histogram is None:
+               histogram = self.histograms[name] = LatencyHistogram()
+           histogram.record(seconds)
+
+   def reset(self):
+       self.counters = {}
+       self.histograms = {}
+
+   def snapshot(self):
+       return {"counters": dict(self.counters),
+               "latency_seconds": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}}
+
+   def to_json(self):
+       return json.dumps(self.snapshot(), indent=2)
+
+   def to_prometheus(self):
+       # Prometheus text format, one histogram per operation
+       lines = []
+       for name, value in sorted(self.counters.items()):
+           lines.append(f"# TYPE ars_{name}_total counter")
+           lines.append(f"ars_{name}_total {value}")
+       for name, histogram in sorted(self.histograms.items()):
+           metric = f"ars_{name}_seconds"
+           lines.append(f"# TYPE {metric} histogram")
+           running = 0
+           for upper in sorted(histogram.buckets):
+               running += histogram.buckets[upper]
+               lines.append(f'{metric}_bucket{{le="{upper / 1000000.0:.6f}"}} {running}')
+           lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+           lines.append(f"{metric}_sum {histogram.total:.6f}")
+           lines.append(f"{metric}_count {histogram.count}")
+       return "\n".join(lines) + "\n"
+
+   def export(self, path, fmt="prometheus"):
+       # Write a snapshot to a file ("prometheus" or "json")
+       text = self.to_json() if fmt == "json" else self.to_prometheus()
+       temp_path = path + ".tmp"
+       with open(temp_path, "w") as f:
+           f.write(text)
+       os.replace(temp_path, path)
+
+   def send(self, host, port, fmt="prometheus"):
+       # Push a snapshot to a collector listening on a TCP socket
+       text = self.to_json() if fmt == "json" else self.to_prometheus()
+       with socket.create_connection((host, port), timeout=5) as connection:
+           connection.sendall(text.encode("utf-8"))
+
+# Decorator that times a method into self.metrics; costs one flag check while disabled
+def instrumented(name):
+   def decorate(method):
+       @functools.wraps(method)
+       def wrapper(self, *args, **kwargs):
+           metrics = self.metrics
+           trace = self.trace if name in TRACED_OPERATIONS else None
+           if trace is not None and getattr(trace.inside, "name", None):
+               trace = None # Called by another traced operation, which makes this call again on replay
+           if not metrics.enabled and trace is None:
+               return method(self, *args, **kwargs)
+           start = time.perf_counter()
+           result = error = None
+           if trace is not None:
+               trace.inside.name = name
+           try:
+               result = method(self, *args, **kwargs)
+               return result
+           except Exception as exc:
+               error = exc
+               if metrics.enabled:
+                   metrics.increment(f"{name}_errors")
+               raise
+           finally:
+               elapsed = time.perf_counter() - start
+               if metrics.enabled:
+                   metrics.observe(name, elapsed)
+               if trace is not None:
+                   trace.inside.name = None
+                   trace.record(name, args, kwargs, elapsed, result, error)
+       return wrapper
+   return decorate
+
+# Short JSON-friendly summary of a result, enough to tell whether a replay behaved the same
+def trace_outcome(result, error=None):
+   if error is not None:
+       return {"error": type(error).__name__}
+   if isinstance(result, (Flight, ScheduleRule)):
+       return result.code
+   if isinstance(result, str):
+       return {"lines": len(result.splitlines())}
+   if isinstance(result, dict):
+       return {key: len(value) for key, value in result.items()}
+   return result
+
+# Appends every traced operation (arguments, start time, duration, outcome) to a JSONL file,
+# so a real session can be replayed later as a benchmark (see replay_trace in load_test.py)
+class TraceRecorder:
+   def __init__(self, path=TRACE_FILE):
+       self.path = path
+       self.lock = threading.Lock() # Counters on several threads share the file
+       self.inside = threading.local() # Traced operation running on this thread, so nested ones aren't recorded twice
+       self.file = open(path, "a")
+
+   def record(self, name, args, kwargs, seconds, result=None, error=None):
+       entry = {"ts": time.time() - seconds, "op": name, "args": list(args), "ms": seconds * 1000,
+                "outcome": trace_outcome(result, error)}
+       if kwargs:
+           entry["kwargs"] = kwargs
+       line = json.dumps(entry, default=str)
+       with self.lock:
+           self.file.write(line + "\n")
+           self.file.flush()
+
+   def close(self):
+       self.file.close()
+
+# Lock that also records how long callers waited for it when metrics are on
+class TimedLock:
+   def __init__(self, metrics, name, lock=None):
+       self.metrics = metrics
+       self.name = name # Histogram name for the wait time
+       self.inner = lock if lock is not None else threading.RLock()
+
+   def __enter__(self):
+       if not self.metrics.enabled:
+           self.inner.acquire()
+           return self
+       start = time.perf_counter()
+       self.inner.acquire()
+       self.metrics.observe(self.name, time.perf_counter() - start)
+       return self
+
+   def __exit__(self, *exc_info):
+       self.inner.release()
+       return False
+
+# Profiles GUI handlers (or any call) and logs slow ones to a rotating file
+class Profiler:
+   def __init__(self, slow_ms=200, directory="profiles", log_path="slow_events.log"):
+       self.slow_ms = slow_ms # Calls or event loop stalls longer than this are logged
+       self.directory = directory # Where the .prof files are written
+       self.profiles = {} # Handler name -> pstats.Stats with all its calls added up
+       self.current = None # Name of the handler that is running right now
+       self.logger = logging.getLogger(f"ars.profiler.{id(self)}")
+       self.logger.setLevel(logging.INFO)
+       self.logger.propagate = False
+       handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=1000000, backupCount=3)
+       handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+       self.logger.addHandler(handler)
+
+   def run(self, name, func, *args, **kwargs):
+       # Call func under cProfile; a call that used more CPU than slow_ms is logged with its top functions
+       if self.current is not None:
+           return func(*args, **kwargs) # Nested handler (e.g. a refresh from show_frame): part of the outer profile
+       profile = cProfile.Profile()
+       previous, self.current = self.current, name
+       wall_start, cpu_start = time.perf_counter(), time.process_time()
+       try:
+           return profile.runcall(func, *args, **kwargs)
+       finally:
+           wall_ms = (time.perf_counter() - wall_start) * 1000
+           cpu_ms = (time.process_time() - cpu_start) * 1000 # Dialogs waiting on the clerk don't count
+           self.current = previous
+           if name in self.profiles:
+               self.profiles[name].add(profile)
+           else:
+               self.profiles[name] = pstats.Stats(profile)
+           if cpu_ms > self.slow_ms:
+               buffer = io.StringIO()
+               pstats.Stats(profile, stream=buffer).sort_stats("cumulative").print_stats(10)
+               self.logger.warning("slow handler %s: %.1f ms cpu, %.1f ms wall\n%s", name, cpu_ms, wall_ms, buffer.getvalue())
+
+   def watch_event_loop(self, window, interval_ms=100):
+       # Heartbeat on the Tk loop: if it fires late, some callback blocked the loop
+       expected = [time.perf_counter() + interval_ms / 1000.0]
+
+       def beat():
+           now = time.perf_counter()
+           blocked_ms = (now - expected[0]) * 1000
+           if blocked_ms > self.slow_ms:
+               self.logger.warning("event loop blocked for %.1f ms (handler: %s)", blocked_ms, self.current or "unknown")
+           expected[0] = now + interval_ms / 1000.0
+           window.after(interval_ms, beat)
+
+       window.after(interval_ms, beat)
+
+   def dump(self):
+       # Save one .prof file per handler (open with pstats or snakeviz)
+       os.makedirs(self.directory, exist_ok=True)
+       for name, stats in self.profiles.items():
+           stats.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+
+   def report(self, limit=15):
+       # Text summary of every profiled handler, slowest functions first
+       buffer = io.StringIO()
+       for name, stats in sorted(self.profiles.items()):
+           buffer.write(f"=== {name} ===\n")
+           stats.stream = buffer
+           stats.sort_stats("cumulative").print_stats(limit)
+       return buffer.getvalue()
+
+# Decorator for GUI handlers: runs them through the app's profiler when profiling is on
+def profiled_handler(name):
+   def decorate(method):
+       @functools.wraps(method)
+       def wrapper(self, *args, **kwargs):
+           profiler = self.app.profiler
+           if profiler is None:
+               return method(self, *args, **kwargs)
+           return profiler.run(name, method, self, *args, **kwargs)
+       return wrapper
+   return decorate
+
+# Fares by fare class, days to departure and load factor. Every flight keeps a small table of
+# all its fares; a quote is a table lookup, and a sale only rebuilds the table when the load
+# factor moves into another bucket.
+class FareEngine:
+   FARE_CLASSES = {"economy": 1.0, "business": 2.5, "first": 4.0} # Multiplier on the base fare
+   DAY_LIMITS = [1, 3, 7, 14, 21, 30, 60] # Upper day limit of each bucket (last bucket is everything later)
+   DAY_MULTIPLIERS = [1.8, 1.5, 1.3, 1.15, 1.05, 1.0, 0.9, 0.85] # Closer to departure costs more
+   LOAD_LIMITS = [0.5, 0.7, 0.85, 0.95] # Upper load factor of each bucket
+   LOAD_MULTIPLIERS = [1.0, 1.1, 1.25, 1.45, 1.7] # Fuller flights cost more
+
+   def __init__(self, system):
+       self.system = system
+       self.tables_built = 0 # How many tables were (re)computed, handy to check the incremental updates
+       system.events.subscribe(BookingCreated, self.seats_changed)
+       system.events.subscribe(BookingCancelled, self.seats_changed)
+
+   def load_bucket(self, flight):
+       sold = self.system.booked_count(flight.code)
+       load = sold / flight.capacity if flight.capacity else 1.0
+       return bisect.bisect_left(self.LOAD_LIMITS, load)
+
+   def build_table(self, flight):
+       # Every fare class x days bucket in one pass
+       bucket = self.load_bucket(flight)
+       load_multiplier = self.LOAD_MULTIPLIERS[bucket]
+       flight.fare_table = {
+           fare_class: [round(flight.base_fare * class_multiplier * day_multiplier * load_multiplier, 2)
+                        for day_multiplier in self.DAY_MULTIPLIERS]
+           for fare_class, class_multiplier in self.FARE_CLASSES.items()
+       }
+       flight.fare_load_bucket = bucket
+       self.tables_built += 1
+
+   def seats_changed(self, event):
+       flight = self.system.get_flight(event.code)
+       if flight is not None and flight.fare_table is not None and self.load_bucket(flight) != flight.fare_load_bucket:
+           self.build_table(flight) # Only when the price level really changes
+
+   def day_bucket(self, flight, now):
+       departure = parse_departure(flight.date_time)
+       days = (departure - now).days if departure else self.DAY_LIMITS[-1] + 1
+       return bisect.bisect_left(self.DAY_LIMITS, max(days, 0))
+
+   def quote(self, flight, fare_class="economy", now=None):
+       if flight.fare_table is None:
+           self.build_table(flight)
+       return flight.fare_table[fare_class][self.day_bucket(flight, now or datetime.now())]
+
+# Number of single-letter edits (insert, delete, replace) to turn one string into another
+def edit_distance(a, b):
+   previous = list(range(len(b) + 1))
+   for i, char_a in enumerate(a, start=1):
+       current = [i]
+       for j, char_b in enumerate(b, start=1):
+           current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+       previous = current
+   return previous[-1]
+
+# Inverted index from 3-letter pieces of a name to the names containing them, for fuzzy search
+class TrigramIndex:
+   def __init__(self):
+       self.postings = {} # Trigram -> set of names
+
+   @staticmethod
+   def trigrams(text):
+       padded = f"  {text.lower()} " # Padding makes the start of a name count more
+       return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+   def add(self, name):
+       for trigram in self.trigrams(name):
+           self.postings.setdefault(trigram, set()).add(name)
+
+   def remove(self, name):
+       for trigram in self.trigrams(name):
+           names = self.postings.get(trigram)
+           if names is not None:
+               names.discard(name)
+               if not names:
+                   del self.postings[trigram]
+
+   def clear(self):
+       self.postings = {}
+
+   def search(self, query, limit=5, candidates=50):
+       # Names sharing the most trigrams with the query, re-ranked by edit distance.
+       # Rare trigrams pick the candidates; very common ones (like " ma") only add to their scores.
+       shared = {}
+       for trigram in sorted(self.trigrams(query), key=lambda trigram: len(self.postings.get(trigram, ()))):
+           names = self.postings.get(trigram, ())
+           if len(names) <= 1000 or len(names) <= len(shared) or not shared:
+               for name in names:
+                   shared[name] = shared.get(name, 0) + 1
+           else:
+               for name in shared:
+                   if name in names:
+                       shared[name] += 1
+       best = heapq.nlargest(candidates, shared.items(), key=lambda item: item[1])
+       lowered = query.lower()
+       ranked = sorted(best, key=lambda item: (edit_distance(lowered, item[0].lower()), -item[1], item[0]))
+       return [name for name, _ in ranked[:limit]]
+
+# Small least-recently-used cache with a size limit and hit/miss counters
+class LRUCache:
+   def __init__(self, capacity=256):
+       self.capacity = capacity # Max number of entries kept in memory
+       self.entries = OrderedDict() # Key -> value, oldest first
+       self.hits = 0 # Lookups answered from the cache
+       self.misses = 0 # Lookups that had to be computed
+       self.lock = threading.Lock() # Readers run outside the reservation lock while writers invalidate
+
+   def get(self, key, default=None):
+       with self.lock:
+           if key in self.entries:
+               self.entries.move_to_end(key) # Mark as most recently used
+               self.hits += 1
+               return self.entries[key]
+           self.misses += 1
+           return default
+
+   def put(self, key, value):
+       with self.lock:
+           self.entries[key] = value
+           self.entries.move_to_end(key)
+           if len(self.entries) > self.capacity:
+               self.entries.popitem(last=False) # Drop the least recently used entry
+
+   def invalidate(self, key):
+       with self.lock:
+           self.entries.pop(key, None) # Forget one entry if it is cached
+
+   def clear(self):
+       with self.lock:
+           self.entries.clear()
+
+   def stats(self):
+       return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "capacity": self.capacity}
+
+# Write JSON to a temp file first and then swap it in, so a crash never leaves half a file
+def write_json_atomic(path, data):
+   temp_path = path + ".tmp"
+   with open(temp_path, "w") as f:
+       json.dump(data, f)
+   os.replace(temp_path, path)
+
+# The data files (flights.json, bookings.json, ...) kept in a folder on disk
+class FileStorage:
+   def __init__(self, directory="."):
+       self.directory = directory
+       os.makedirs(directory, exist_ok=True)
+
+   def path(self, name):
+       return os.path.join(self.directory, name)
+
+   def exists(self, name):
+       return os.path.exists(self.path(name))
+
+   def read_json(self, name):
+       with open(self.path(name), "r") as f:
+           return json.load(f)
+
+   def write_json(self, name, data, atomic=False):
+       if atomic:
+           write_json_atomic(self.path(name), data)
+           return
+       with open(self.path(name), "w") as f:
+           json.dump(data, f)
+
+   def read_lines(self, name):
+       with open(self.path(name), "r") as f:
+           yield from f
+
+   def append_lines(self, name, lines):
+       with open(self.path(name), "a") as f:
+           f.writelines(lines)
+
+   def write_lines(self, name, lines):
+       # Replace the whole file in one step
+       temp_path = self.path(name) + ".tmp"
+       with open(temp_path, "w") as f:
+           f.writelines(lines)
+       os.replace(temp_path, self.path(name))
+
+   def remove(self, name):
+       os.remove(self.path(name))
+
+   def signature(self, name):
+       # Changes whenever the file is rewritten; None if there is no file
+       try:
+           info = os.stat(self.path(name))
+       except FileNotFoundError:
+           return None
+       return (info.st_mtime_ns, info.st_size)
+
+# The same files kept as text in memory, so tests and benchmarks never touch the disk or each other
+class MemoryStorage:
+   def __init__(self):
+       self.files = {} # File name -> text
+       self.versions = {} # File name -> number of writes, stands in for the modification time
+       self.lock = threading.Lock()
+
+   def path(self, name):
+       # Only file based features (shared mode, snapshots, archives, shards...) ask for a real path
+       raise ValueError(f"{name} needs a data directory; in-memory storage has no files")
+
+   def exists(self, name):
+       return name in self.files
+
+   def _read(self, name):
+       try:
+           return self.files[name]
+       except KeyError:
+           raise FileNotFoundError(name) from None
+
+   def _write(self, name, text):
+       with self.lock:
+           self.files[name] = text
+           self.versions[name] = self.versions.get(name, 0) + 1
+
+   def read_json(self, name):
+       return json.loads(self._read(name))
+
+   def write_json(self, name, data, atomic=False):
+       self._write(name, json.dumps(data)) # Always all at once
+
+   def read_lines(self, name):
+       return io.StringIO(self._read(name))
+
+   def append_lines(self, name, lines):
+       with self.lock:
+           self.files[name] = self.files.get(name, "") + "".join(lines)
+           self.versions[name] = self.versions.get(name, 0) + 1
+
+   def write_lines(self, name, lines):
+       self._write(name, "".join(lines))
+
+   def remove(self, name):
+       with self.lock:
+           self._read(name)
+           del self.files[name]
+
+   def signature(self, name):
+       if name not in self.files:
+           return None
+       return (self.versions[name], len(self.files[name]))
+
+# Bookings split across several files by flight code, so a write only touches one shard.
+# Threads of one process write different shards in parallel; in shared mode all writers are
+# serialized by reservations.lock, so there the gain is only the smaller files.
+class ShardedBookingStore:
+   def __init__(self, directory="booking_shards", shard_count=4, metrics=None):
+       self.metrics = metrics if metrics is not None else MetricsRegistry() # Shared with the ReservationSystem
+       self.directory = directory # Folder holding the shard files
+       self.shard_count = shard_count # How many shards to spread bookings over
+       self.shards = [] # One dictionary (name -> code) per shard
+       self.locks = [] # One lock per shard so different shards never wait on each other
+       self.pending = [] # Per shard: changes not written to disk yet
+       self.log_lines = [] # Per shard: lines in the file, used to decide when to compact
+       self._reset(shard_count)
+
+   def _reset(self, shard_count):
+       self.shard_count = shard_count
+       self.shards = [{} for _ in range(shard_count)]
+       self.locks = [TimedLock(self.metrics, "shard_lock_wait", threading.Lock()) for _ in range(shard_count)]
+       self.pending = [[] for _ in range(shard_count)]
+       self.log_lines = [0] * shard_count
+
+   def shard_for(self, code):
+       # crc32 gives the same answer in every run (unlike hash())
+       return zlib.crc32(code.encode("utf-8")) % self.shard_count
+
+   def shard_path(self, index):
+       return os.path.join(self.directory, f"shard_{index:03d}.jsonl")
+
+   def manifest_path(self):
+       return os.path.join(self.directory, "manifest.json")
+
+   @instrumented("shard_load")
+   def load(self, legacy_bookings=None):
+       # Read every shard file; each line is one change ({"n": name, "c": code or None})
+       wanted = self.shard_count
+       os.makedirs(self.directory, exist_ok=True)
+       if not os.path.exists(self.manifest_path()):
+           # First run in sharded mode: import the single bookings file if there is one
+           self._reset(wanted)
+           for name, code in (legacy_bookings or {}).items():
+               self.put(name, code)
+           self.flush()
+           write_json_atomic(self.manifest_path(), {"shard_count": wanted})
+           return self.all_bookings()
+       with open(self.manifest_path(), "r") as f:
+           stored = json.load(f)["shard_count"]
+       self._reset(stored)
+       for index in range(stored):
+           path = self.shard_path(index)
+           if not os.path.exists(path):
+               continue
+           with open(path, "r") as f:
+               for line in f:
+                   if not line.strip():
+                       continue
+                   change = json.loads(line)
+                   self.log_lines[index] += 1
+                   if change["c"] is None:
+                       self.shards[index].pop(change["n"], None)
+                   else:
+                       self.shards[index][change["n"]] = change["c"]
+       if stored != wanted:
+           self.rebalance(wanted) # Shard count was changed since the last run
+       return self.all_bookings()
+
+   def all_bookings(self):
+       bookings = {}
+       for shard in self.shards:
+           bookings.update(shard)
+       return bookings
+
+   def put(self, name, code, old_code=None, written=False):
+       # Record a booking; a move between flights may also touch the old shard.
+       # written=True: another process already appended it to the shard file, only memory changes.
+       if old_code is not None and self.shard_for(old_code) != self.shard_for(code):
+           self.remove(name, old_code, written)
+       index = self.shard_for(code)
+       with self.locks[index]:
+           self.shards[index][name] = code
+           self._note_change(index, {"n": name, "c": code}, written)
+
+   def remove(self, name, code, written=False):
+       index = self.shard_for(code)
+       with self.locks[index]:
+           self.shards[index].pop(name, None)
+           self._note_change(index, {"n": name, "c": None}, written)
+
+   def _note_change(self, index, change, written):
+       if written:
+           self.log_lines[index] += 1 # Counts toward compaction like our own lines
+       else:
+           self.pending[index].append(change)
+
+   @instrumented("shard_flush")
+   def flush(self):
+       # Append pending changes, writing the dirty shards in parallel
+       dirty = [index for index in range(self.shard_count) if self.pending[index]]
+       if len(dirty) == 1:
+           self._flush_shard(dirty[0])
+       elif dirty:
+           with ThreadPoolExecutor(max_workers=min(len(dirty), 8)) as pool:
+               list(pool.map(self._flush_shard, dirty))
+
+   def _flush_shard(self, index):
+       with self.locks[index]:
+           changes, self.pending[index] = self.pending[index], []
+           with open(self.shard_path(index), "a") as f:
+               for change in changes:
+                   f.write(json.dumps(change) + "\n")
+           self.log_lines[index] += len(changes)
+           # Compact once the file is mostly old, overwritten changes
+           if self.log_lines[index] > 2 * len(self.shards[index]) + 64:
+               self._compact_locked(index)
+
+   @instrumented("shard_compact")
+   def compact(self, index=None):
+       # Rewrite one shard (or all of them) so the file only holds live bookings
+       for i in (range(self.shard_count) if index is None else [index]):
+           with self.locks[i]:
+               self._compact_locked(i)
+
+   def _compact_locked(self, index):
+       temp_path = self.shard_path(index) + ".tmp"
+       with open(temp_path, "w") as f:
+           for name, code in self.shards[index].items():
+               f.write(json.dumps({"n": name, "c": code}) + "\n")
+       os.replace(temp_path, self.shard_path(index))
+       self.log_lines[index] = len(self.shards[index])
+
+   def replace_all(self, bookings):
+       # Throw away the shard contents and write these bookings instead
+       self._reset(self.shard_count)
+       for name, code in bookings.items():
+           self.shards[self.shard_for(code)][name] = code
+       for index in range(self.shard_count):
+           self._compact_locked(index)
+
+   @instrumented("shard_rebalance")
+   def rebalance(self, shard_count):
+       # Spread the bookings over a new number of shards and rewrite the files
+       bookings = self.all_bookings()
+       old_count = self.shard_count
+       self._reset(shard_count)
+       for name, code in bookings.items():
+           self.shards[self.shard_for(code)][name] = code
+       for index in range(shard_count):
+           self._compact_locked(index)
+       for index in range(shard_count, old_count):
+           if os.path.exists(self.shard_path(index)):
+               os.remove(self.shard_path(index)) # Shard no longer used
+       write_json_atomic(self.manifest_path(), {"shard_count": shard_count})
+
+# Two-way table between strings and dense integer ids (0, 1, 2, ...); ids are never reused
+class Interner:
+   def __init__(self):
+       self.ids = {} # Text -> id
+       self.values = [] # Id -> text
+
+   def __len__(self):
+       return len(self.values)
+
+   def encode(self, value):
+       # Id of the value, adding it if it is new
+       value_id = self.ids.get(value)
+       if value_id is None:
+           value_id = self.ids[value] = len(self.values)
+           self.values.append(value)
+       return value_id
+
+   def lookup(self, value):
+       return self.ids.get(value) # None if the value was never seen
+
+   def decode(self, value_id):
+       return self.values[value_id]
+
+# Bookings kept as one flight id per passenger id, read and written like the old name -> code
+# dictionary. Each name and code is stored once in the interners, the flights column is a compact
+# int array, and joins on ids compare small ints instead of strings.
+class EncodedBookings(MutableMapping):
+   NONE = -1 # Flight id of a passenger with no booking
+
+   def __init__(self, passengers, flights, data=None):
+       self.passengers = passengers # Interner for passenger names
+       self.flights = flights # Interner for flight codes
+       self.flight_of = array.array("i") # Passenger id -> flight id (NONE if not booked)
+       self.count = 0 # Live bookings
+       if data and isinstance(data.get("bookings"), list): # Saved by to_json
+           codes = [flights.encode(code) for code in data["flights"]]
+           for name, flight in zip(data["passengers"], data["bookings"]):
+               self._put(passengers.encode(name), codes[flight])
+       else: # Plain name -> code dictionary (older files, snapshots, other stores)
+           for name, code in (data or {}).items():
+               self[name] = code
+
+   def _flight(self, name):
+       passenger = self.passengers.lookup(name)
+       if passenger is None or passenger >= len(self.flight_of) or self.flight_of[passenger] == self.NONE:
+           raise KeyError(name)
+       return passenger
+
+   def _put(self, passenger, flight):
+       if passenger >= len(self.flight_of):
+           self.flight_of.extend([self.NONE] * (passenger + 1 - len(self.flight_of)))
+       if self.flight_of[passenger] == self.NONE:
+           self.count += 1
+       self.flight_of[passenger] = flight
+
+   def __getitem__(self, name):
+       return self.flights.decode(self.flight_of[self._flight(name)])
+
+   def __setitem__(self, name, code):
+       self._put(self.passengers.encode(name), self.flights.encode(code))
+
+   def __delitem__(self, name):
+       self.flight_of[self._flight(name)] = self.NONE
+       self.count -= 1
+
+   def __len__(self):
+       return self.count
+
+   def __iter__(self):
+       decode = self.passengers.decode
+       return (decode(passenger) for passenger, _ in self.ids())
+
+   def ids(self):
+       # (passenger id, flight id) of every booking
+       return ((passenger, flight) for passenger, flight in enumerate(self.flight_of) if flight != self.NONE)
+
+   def items(self):
+       for passenger, flight in self.ids():
+           yield self.passengers.decode(passenger), self.flights.decode(flight)
+
+   def frozen(self):
+       # Copy of the raw columns (no decoding), cheap enough to take under the system lock
+       return (self.flight_of[:], self.passengers.values[:], self.flights.values[:])
+
+   @staticmethod
+   def thaw(frozen):
+       # Name -> code dictionary from a frozen() copy
+       flight_of, names, codes = frozen
+       return {names[passenger]: codes[flight] for passenger, flight in enumerate(flight_of) if flight != EncodedBookings.NONE}
+
+   def to_json(self):
+       # Encoding table for the codes plus one flight number per passenger; cancelled passengers and
+       # codes nobody is booked on are left out, so the file only holds live data
+       booked = list(self.ids())
+       table = {} # Flight id -> position in the saved table
+       for _, flight in booked:
+           table.setdefault(flight, len(table))
+       return {"flights": [self.flights.decode(flight) for flight in table],
+               "passengers": [self.passengers.decode(passenger) for passenger, _ in booked],
+               "bookings": [table[flight] for _, flight in booked]}
+
+# Booking store kept in memory-mapped binary files instead of a parsed JSON dictionary:
+#   bookings.str - string table: each passenger name and flight code as a 2-byte length + UTF-8 bytes
+#   bookings.bin - header + fixed-width records (passenger id, flight-code id, name hash, status)
+#   bookings.idx - open addressing hash table: name hash -> record number
+# Ids are offsets into the string table. A lookup only reads the pages it touches, so opening
+# a store with millions of bookings is instant. Cancels tombstone the record in place and the
+# record is reused if the passenger books again. Meant for one process (not shared mode).
+class BinaryBookingStore(MutableMapping):
+   HEADER = struct.Struct("<4sIQQQ") # Magic, version, records used, live bookings, change counter
+   RECORD = struct.Struct("<QQIB3x") # Name id, code id, name hash, status
+   SLOT = struct.Struct("<Q") # Record number + 1 (0 = empty slot)
+   LENGTH = struct.Struct("<H") # Length of a string in the string table
+   MAGIC = b"ARSB"
+   CANCELLED, LIVE = 0, 1
+
+   def __init__(self, prefix="bookings"):
+       self.paths = {part: f"{prefix}.{part}" for part in ("bin", "idx", "str")}
+       self.counts_path = f"{prefix}.counts.json" # Bookings per flight, so seat counts need no scan
+       self.files = {} # Part -> open file
+       self.maps = {} # Part -> mmap of the file
+       self.used = 0 # Records written (live or cancelled)
+       self.live = 0 # Live bookings
+       self.changes = 0 # Goes up on every write, so a stale counts file is noticed
+       self.slot_count = 0 # Size of the hash table
+       self.strings_size = 0 # Bytes in the string table
+       self.code_ids = {} # Flight code -> string id, filled as codes are written or read
+       self.codes = {} # String id -> flight code
+       self.counts = None # Flight code -> live bookings, None until loaded or counted
+       self.lock = threading.RLock() # Growing a file swaps its mmap, so readers and writers take turns
+
+   def exists(self):
+       return os.path.exists(self.paths["bin"])
+
+   def open(self, legacy_bookings=None):
+       # Map the files (creating them the first time, with the JSON bookings imported)
+       self.close()
+       if not self.exists():
+           self._create(legacy_bookings or {})
+       for part, path in self.paths.items():
+           # Strings are read back through a new mmap right after they are appended, so they skip the write buffer
+           self.files[part] = open(path, "r+b", buffering=0 if part == "str" else -1)
+       self._map_all()
+       magic, _, self.used, self.live, self.changes = self.HEADER.unpack_from(self.maps["bin"], 0)
+       if magic != self.MAGIC:
+           raise ValueError(f"{self.paths['bin']} is not a booking store")
+       (self.slot_count,) = self.SLOT.unpack_from(self.maps["idx"], 0)
+       self.strings_size = os.path.getsize(self.paths["str"])
+       self.code_ids, self.codes = {}, {}
+       self.counts = None
+       if os.path.exists(self.counts_path):
+           with open(self.counts_path, "r") as f:
+               saved = json.load(f)
+           if saved["changes"] == self.changes: # Still matches the records
+               self.counts = saved["counts"]
+       return self
+
+   def _create(self, bookings):
+       with open(self.paths["str"], "wb") as f:
+           f.write(self.MAGIC) # An mmap can't be empty, and id 0 must not be a real string
+       with open(self.paths["bin"], "wb") as f:
+           f.write(self.HEADER.pack(self.MAGIC, 1, 0, 0, 0))
+           f.truncate(self.HEADER.size + 1024 * self.RECORD.size)
+       slot_count = 2048
+       while slot_count * 7 < len(bookings) * 10:
+           slot_count *= 2
+       with open(self.paths["idx"], "wb") as f:
+           f.write(self.SLOT.pack(slot_count))
+           f.truncate(self.SLOT.size * (slot_count + 1))
+       if bookings:
+           self.open()
+           for name, code in bookings.items():
+               self[name] = code
+           self.flush()
+           self.close()
+
+   def _map_all(self):
+       for part in self.paths:
+           self._map(part)
+
+   def _map(self, part):
+       if part in self.maps:
+           self.maps[part].close()
+       self.maps[part] = mmap.mmap(self.files[part].fileno(), 0)
+
+   def close(self):
+       for part in list(self.maps):
+           self.maps.pop(part).close()
+       for part in list(self.files):
+           self.files.pop(part).close()
+
+   def flush(self):
+       with self.lock:
+           self._flush()
+
+   def _flush(self):
+       for part in ("bin", "idx"):
+           self.maps[part].flush()
+       self.files["str"].flush()
+       write_json_atomic(self.counts_path, {"changes": self.changes, "counts": self.count_all()})
+
+   def _write_header(self):
+       self.changes += 1
+       self.HEADER.pack_into(self.maps["bin"], 0, self.MAGIC, 1, self.used, self.live, self.changes)
+
+   def _string(self, string_id):
+       strings = self.maps["str"]
+       if string_id + self.LENGTH.size > len(strings):
+           self._map("str") # Written after the table was mapped
+           strings = self.maps["str"]
+       (length,) = self.LENGTH.unpack_from(strings, string_id)
+       start = string_id + self.LENGTH.size
+       return strings[start:start + length].decode("utf-8")
+
+   def _add_string(self, text):
+       data = text.encode("utf-8")
+       string_id = self.strings_size
+       f = self.files["str"]
+       f.seek(string_id)
+       f.write(self.LENGTH.pack(len(data)) + data)
+       self.strings_size += self.LENGTH.size + len(data)
+       return string_id
+
+   def _code_id(self, code):
+       if code not in self.code_ids:
+           self.code_ids[code] = self._add_string(code) # At most one copy per code per session
+           self.codes[self.code_ids[code]] = code
+       return self.code_ids[code]
+
+   def _code(self, code_id):
+       code = self.codes.get(code_id)
+       if code is None:
+           code = self.codes[code_id] = self._string(code_id)
+           self.code_ids.setdefault(code, code_id)
+       return code
+
+   def _record(self, number):
+       return self.RECORD.unpack_from(self.maps["bin"], self.HEADER.size + number * self.RECORD.size)
+
+   def _write_record(self, number, name_id, code_id, name_hash, status):
+       self.RECORD.pack_into(self.maps["bin"], self.HEADER.size + number * self.RECORD.size, name_id, code_id, name_hash, status)
+
+   def _find(self, name):
+       # (record number or -1, hash table slot for the name, name hash)
+       name_hash = zlib.crc32(name.encode("utf-8"))
+       index = self.maps["idx"]
+       slot = name_hash % self.slot_count
+       while True:
+           (entry,) = self.SLOT.unpack_from(index, self.SLOT.size * (slot + 1))
+           if entry == 0:
+               return -1, slot, name_hash
+           name_id, _, record_hash, _ = self._record(entry - 1)
+           if record_hash == name_hash and self._string(name_id) == name:
+               return entry - 1, slot, name_hash
+           slot = (slot + 1) % self.slot_count
+
+   def _count(self, code, change):
+       if self.counts is not None:
+           self.counts[code] = self.counts.get(code, 0) + change
+           if not self.counts[code]:
+               del self.counts[code]
+
+   def __getitem__(self, name):
+       with self.lock:
+           number, _, _ = self._find(name)
+           if number < 0:
+               raise KeyError(name)
+           _, code_id, _, status = self._record(number)
+           if status != self.LIVE:
+               raise KeyError(name)
+           return self._code(code_id)
+
+   def __setitem__(self, name, code):
+       with self.lock:
+           self._put(name, code)
+
+   def _put(self, name, code):
+       number, slot, name_hash = self._find(name)
+       if number >= 0:
+           name_id, old_code_id, _, status = self._record(number)
+           if status == self.LIVE:
+               self._count(self._code(old_code_id), -1)
+           else:
+               self.live += 1
+           self._write_record(number, name_id, self._code_id(code), name_hash, self.LIVE) # Updated in place
+       else:
+           if self.HEADER.size + (self.used + 1) * self.RECORD.size > len(self.maps["bin"]):
+               self._grow_records()
+           self._write_record(self.used, self._add_string(name), self._code_id(code), name_hash, self.LIVE)
+           self.SLOT.pack_into(self.maps["idx"], self.SLOT.size * (slot + 1), self.used + 1)
+           self.used += 1
+           self.live += 1
+           if self.used * 10 > self.slot_count * 7:
+               self._rehash(self.slot_count * 2)
+       self._count(code, 1)
+       self._write_header()
+
+   def __delitem__(self, name):
+       with self.lock:
+           number, _, name_hash = self._find(name)
+           if number < 0:
+               raise KeyError(name)
+           name_id, code_id, _, status = self._record(number)
+           if status != self.LIVE:
+               raise KeyError(name)
+           self._write_record(number, name_id, code_id, name_hash, self.CANCELLED) # Tombstone, the record is kept
+           self.live -= 1
+           self._count(self._code(code_id), -1)
+           self._write_header()
+
+   def __len__(self):
+       return self.live
+
+   def __iter__(self):
+       for name, _ in self.items():
+           yield name
+
+   def items(self):
+       # Walk the records in order; this touches every page, unlike single lookups
+       for number in range(self.used):
+           with self.lock:
+               name_id, code_id, _, status = self._record(number)
+               item = (self._string(name_id), self._code(code_id)) if status == self.LIVE else None
+           if item:
+               yield item
+
+   def count(self, code):
+       # Live bookings on one flight
+       return self.count_all().get(code, 0)
+
+   def count_all(self):
+       with self.lock:
+           if self.counts is None: # No up to date counts file, count once
+               counts = {}
+               for _, code in self.items():
+                   counts[code] = counts.get(code, 0) + 1
+               self.counts = counts
+           return self.counts
+
+   def _grow_records(self):
+       f = self.files["bin"]
+       f.truncate(self.HEADER.size + 2 * max(self.used, 1024) * self.RECORD.size)
+       self._map("bin")
+
+   def _rehash(self, slot_count):
+       # Bigger hash table, rebuilt in place from the records
+       f = self.files["idx"]
+       self.maps["idx"].close()
+       del self.maps["idx"]
+       f.truncate(0)
+       f.truncate(self.SLOT.size * (slot_count + 1))
+       self._map("idx")
+       index = self.maps["idx"]
+       self.SLOT.pack_into(index, 0, slot_count)
+       self.slot_count = slot_count
+       for number in range(self.used):
+           slot = self._record(number)[2] % slot_count
+           while self.SLOT.unpack_from(index, self.SLOT.size * (slot + 1))[0]:
+               slot = (slot + 1) % slot_count
+           self.SLOT.pack_into(index, self.SLOT.size * (slot + 1), number + 1)
+
+# Hashed timer wheel: timers are dropped into a slot by deadline, so expiring
+# them only looks at the slots that passed instead of every timer
+class TimerWheel:
+   def __init__(self, tick=1.0, slot_count=512):
+       self.tick = tick # Seconds covered by one slot
+       self.slots = [{} for _ in range(slot_count)] # Each slot: key -> deadline
+       self.slot_of = {} # Key -> slot index, so cancel is O(1)
+       self.current_tick = None # Last tick that was processed
+
+   def __len__(self):
+       return len(self.slot_of)
+
+   def schedule(self, key, deadline):
+       self.cancel(key)
+       tick = int(deadline // self.tick)
+       if self.current_tick is not None and tick < self.current_tick:
+           tick = self.current_tick # Already overdue, expire on the next advance
+       index = tick % len(self.slots)
+       self.slots[index][key] = deadline
+       self.slot_of[key] = index
+
+   def cancel(self, key):
+       index = self.slot_of.pop(key, None)
+       if index is not None:
+           del self.slots[index][key]
+
+   def advance(self, now):
+       # Return the keys whose deadline is <= now and remove them from the wheel
+       target = int(now // self.tick)
+       if self.current_tick is None:
+           self.current_tick = target - len(self.slots) + 1 # First call looks at the whole wheel
+       expired = []
+       steps = min(target - self.current_tick + 1, len(self.slots)) # Never visit a slot twice
+       for step in range(max(steps, 0)):
+           slot = self.slots[(self.current_tick + step) % len(self.slots)]
+           for key, deadline in list(slot.items()):
+               if deadline <= now: # Later laps of the wheel stay in the slot
+                   del slot[key]
+                   del self.slot_of[key]
+                   expired.append(key)
+       self.current_tick = max(self.current_tick, target)
+       return expired
+
+# Passengers waiting for a seat on one flight, highest priority first, then oldest request
+class Waitlist:
+   def __init__(self):
+       self.order = [] # Entries (-priority, request_time, sequence, name), kept sorted
+       self.entries = {} # Name -> its current entry
+
+   def __len__(self):
+       return len(self.entries)
+
+   def __contains__(self, name):
+       return name in self.entries
+
+   def add(self, name, priority, request_time, sequence):
+       # Returns True if the passenger was not waiting before
+       new = not self.remove(name)
+       entry = (-priority, request_time, sequence, name)
+       self.entries[name] = entry
+       bisect.insort(self.order, entry)
+       return new
+
+   def remove(self, name):
+       entry = self.entries.pop(name, None)
+       if entry is None:
+           return False
+       del self.order[bisect.bisect_left(self.order, entry)]
+       return True
+
+   def pop(self):
+       # Take the first passenger in line, or None if nobody is waiting
+       if not self.order:
+           return None
+       entry = self.order.pop(0)
+       del self.entries[entry[3]]
+       return entry[3]
+
+   def position(self, name):
+       # 1-based place in line, or None if the passenger is not waiting
+       entry = self.entries.get(name)
+       if entry is None:
+           return None
+       return bisect.bisect_left(self.order, entry) + 1
+
+# Raised when a read-only replica is asked to change something
+class ReadOnlyError(Exception):
+   pass
+
+# One flight's passenger manifest as CSV: flight details, then one passenger per row
+def write_manifest(out, flight, names):
+   writer = csv.writer(out)
+   writer.writerow(["flight", flight["code"]])
+   writer.writerow(["destination", flight["destination"]])
+   writer.writerow(["departure", flight["date_time"]])
+   writer.writerow(["passengers", len(names)])
+   writer.writerow(["passenger"])
+   for name in names:
+       writer.writerow([name])
+
+def manifest_text(job):
+   out = io.StringIO()
+   write_manifest(out, *job)
+   return out.getvalue()
+
+# Lock shared by every process using the same data files (does nothing without fcntl)
+class FileLock:
+   def __init__(self, path):
+       self.path = path
+       self.handle = None
+       self.depth = 0 # Nested "with" blocks of the owning thread only lock the file once
+       self.owner = None # Thread holding the lock
+       self.thread_lock = threading.RLock() # Other threads of this process wait here
+
+   def __enter__(self):
+       self.thread_lock.acquire()
+       if self.depth == 0:
+           self.handle = open(self.path, "a")
+           if fcntl:
+               fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+           self.owner = threading.get_ident()
+       self.depth += 1
+       return self
+
+   def __exit__(self, *exc_info):
+       self.depth -= 1
+       if self.depth == 0:
+           self.owner = None
+           if fcntl:
+               fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+           self.handle.close()
+           self.handle = None
+       self.thread_lock.release()
+       return False
+
+   def held(self):
+       # True only for the thread holding the lock, not for other threads of this process
+       return self.owner == threading.get_ident()
+
+# Append-only log of every change, shared by all processes. Each process remembers how far
+# it has read, so it only reads what others added since (checked cheaply with mtime and size).
+class MutationLog:
+   def __init__(self, path="mutations.jsonl"):
+       self.path = path
+       self.offset = 0 # Bytes of the file already read
+       self.base = 0 # Log bytes trimmed off before this file starts, so snapshot offsets survive a trim
+       self.generation = 0 # Number of the last change seen
+       self.signature = None # (mtime, size, inode) when the file was last read
+
+   def _stat(self):
+       try:
+           info = os.stat(self.path)
+       except FileNotFoundError:
+           return (0, 0, 0)
+       return (info.st_mtime_ns, info.st_size, info.st_ino)
+
+   def changed(self):
+       return self._stat() != self.signature
+
+   def position(self):
+       # Offset of the next change that stays valid when the log is trimmed
+       return self.base + self.offset
+
+   def _read_header(self, f):
+       # A trimmed log starts with {"base": position after the header, "gen": ...}; returns (base, generation, header size)
+       line = f.readline()
+       if line.startswith(b'{"base"') and line.endswith(b"\n"):
+           header = json.loads(line)
+           return header["base"] - len(line), header["gen"], len(line)
+       f.seek(0)
+       return 0, 0, 0
+
+   def skip_to_end(self):
+       # Everything written so far is already in the data files, so only the last line is read for its generation
+       signature = self._stat()
+       self.offset, self.base, self.generation = 0, 0, 0
+       if signature[1]:
+           with open(self.path, "rb") as f:
+               self.base, self.generation, self.offset = self._read_header(f)
+               end, size = signature[1], 4096
+               while True:
+                   start = max(self.offset, end - size)
+                   f.seek(start)
+                   tail = f.read(end - start)
+                   last = tail.rfind(b"\n")
+                   previous = tail.rfind(b"\n", 0, max(last, 0))
+                   if previous >= 0 or start == self.offset:
+                       break
+                   size *= 2 # The last line is longer than what was read
+               if last >= 0:
+                   self.offset = start + last + 1 # A half-written line after it is read next time
+                   line = tail[previous + 1:last + 1]
+                   if line.strip():
+                       self.generation = json.loads(line)["gen"]
+       self.signature = signature
+
+   def read_new(self):
+       # Changes added since the last call; None means the log was replaced and everything must be reloaded
+       signature = self._stat()
+       if signature == self.signature:
+           return []
+       replaced = self.signature is not None and self.signature[2] and signature[2] != self.signature[2]
+       if signature[1] < self.offset or replaced:
+           self.offset, self.base, self.generation, self.signature = 0, 0, 0, None
+           return None
+       if signature[1] == 0:
+           self.signature = signature # No log yet
+           return []
+       entries = []
+       with open(self.path, "rb") as f:
+           if self.offset == 0:
+               base, generation, header = self._read_header(f)
+               if base + header > self.base: # Trimmed before we read it all
+                   self.base, self.generation, self.signature = 0, 0, None
+                   return None
+               self.base, self.generation, self.offset = base, generation, header
+           f.seek(self.offset)
+           for line in f:
+               if not line.endswith(b"\n"):
+                   break # Half-written line, read it next time
+               self.offset += len(line)
+               if line.strip():
+                   entry = json.loads(line)
+                   self.generation = entry["gen"]
+                   entries.append(entry)
+       self.signature = signature
+       return entries
+
+   def read_range(self, offset, until):
+       # Entries from a position() up to a timestamp, without touching what this process has read
+       if not os.path.exists(self.path):
+           return
+       with open(self.path, "rb") as f:
+           base, _, header = self._read_header(f)
+           f.seek(max(offset - base, header))
+           for line in f:
+               if not line.endswith(b"\n"):
+                   break
+               if line.strip():
+                   entry = json.loads(line)
+                   if entry["ts"] > until:
+                       break
+                   yield entry
+
+   def append(self, entries):
+       # Caller holds the FileLock and has read everything before, so generations stay in order
+       with open(self.path, "ab") as f:
+           for entry in entries:
+               self.generation += 1
+               entry["gen"] = self.generation
+               f.write((json.dumps(entry) + "\n").encode("utf-8"))
+       self.offset = os.path.getsize(self.path)
+       self.signature = self._stat()
+
+   def trim(self, position):
+       # Drop the log before a position(); the caller holds the FileLock and has read everything.
+       # The file is replaced, so other processes reload from the data files once.
+       if not os.path.exists(self.path):
+           return False
+       with open(self.path, "rb") as f:
+           _, _, header = self._read_header(f)
+           cut = position - self.base
+           size = os.fstat(f.fileno()).st_size
+           if cut <= header or cut > self.offset or cut * 2 < size:
+               return False # Not worth rewriting until at least half the file can go
+           f.seek(cut)
+           rest = f.read()
+       first = rest.split(b"\n", 1)[0]
+       generation = json.loads(first)["gen"] - 1 if first.strip() else self.generation
+       line = (json.dumps({"base": self.base + cut, "gen": generation}) + "\n").encode("utf-8")
+       with open(self.path + ".tmp", "wb") as f:
+           f.write(line)
+           f.write(rest)
+       os.replace(self.path + ".tmp", self.path)
+       self.base += cut - len(line)
+       self.offset += len(line) - cut
+       self.signature = self._stat()
+       return True
+
+# Decorator for changes in shared mode: lock the files, catch up with other processes,
+# run the change, then append it to the mutation log
+def shared_write(method):
+   @functools.wraps(method)
+   def wrapper(self, *args, **kwargs):
+       if self.read_only:
+           raise ReadOnlyError(f"{method.__name__} can't run on a read-only replica")
+       if self.process_lock is None or self.process_lock.held():
+           return method(self, *args, **kwargs) # Not shared, or this thread is already inside a shared write
+       with self.lock, self.process_lock:
+           self.sync()
+           try:
+               return method(self, *args, **kwargs)
+           finally:
+               self._flush_mutations()
+               if self.snapshots:
+                   self.snapshots.maybe_take(self)
+   return wrapper
+
+# Turn "YYYY-MM-DD HH:MM[:SS]", "YYYY-MM-DD" or a Unix time into a Unix time (None if unreadable)
+def parse_timestamp(text):
+   try:
+       return float(text)
+   except (TypeError, ValueError):
+       pass
+   for pattern in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+       try:
+           return datetime.strptime(text, pattern).timestamp()
+       except (TypeError, ValueError):
+           continue
+   return None
+
+# Periodic copies of the whole reservation state. Together with the mutation log they let us
+# rebuild the state at any moment: load the last snapshot before it and replay the log from there.
+class SnapshotManager:
+   def __init__(self, directory="snapshots", interval=SNAPSHOT_INTERVAL, keep=48):
+       self.directory = directory
+       self.interval = interval # Seconds between automatic snapshots
+       self.keep = keep # Older snapshots are deleted
+       self.last_taken = 0.0
+       self.writer = None # Background thread writing the latest snapshot
+
+   def capture(self, system):
+       # Copies taken under the lock: the bookings only as raw columns (see EncodedBookings.frozen),
+       # decoded with everything else on the writer thread
+       with system.lock:
+           return {
+               "ts": time.time(),
+               "generation": system.mutation_log.generation,
+               "log_offset": system.mutation_log.position(), # Replay starts here
+               "flights": [flight.to_dict() for flight in system.flights],
+               "bookings": system.bookings.frozen() if isinstance(system.bookings, EncodedBookings) else dict(system.bookings),
+               "waitlists": {code: [[entry[3], -entry[0], entry[1]] for entry in waitlist.order]
+                             for code, waitlist in system.waitlists.items() if len(waitlist)},
+           }
+
+   def take(self, system, background=True):
+       state = self.capture(system)
+       self.last_taken = state["ts"]
+       self.wait()
+       if background:
+           self.writer = threading.Thread(target=self._write, args=(state,), daemon=True)
+           self.writer.start()
+       else:
+           self._write(state)
+       return state["ts"]
+
+   def maybe_take(self, system):
+       if time.time() - self.last_taken >= self.interval:
+           self.take(system)
+           self.trim_log(system.mutation_log)
+
+   def trim_log(self, log):
+       # The log before the oldest snapshot that is kept can never be replayed again
+       kept = self.list()[-self.keep:]
+       if kept:
+           position = self.log_position(kept[0][1])
+           if position:
+               log.trim(position)
+
+   def wait(self):
+       if self.writer is not None:
+           self.writer.join()
+           self.writer = None
+
+   def _write(self, state):
+       if isinstance(state["bookings"], tuple):
+           state["bookings"] = EncodedBookings.thaw(state["bookings"])
+       os.makedirs(self.directory, exist_ok=True)
+       path = os.path.join(self.directory, f"snapshot-{int(state['ts'] * 1000):013d}-{state['log_offset']}.json.gz")
+       with gzip.open(path + ".tmp", "wt") as f:
+           json.dump(state, f)
+       os.replace(path + ".tmp", path)
+       for old_ts, old_path in self.list()[:-self.keep]:
+           os.remove(old_path)
+
+   def list(self):
+       # (timestamp, path) of every snapshot, oldest first
+       if not os.path.isdir(self.directory):
+           return []
+       snapshots = []
+       for file_name in os.listdir(self.directory):
+           if file_name.startswith("snapshot-") and file_name.endswith(".json.gz"):
+               snapshots.append((int(file_name[9:22]) / 1000.0, os.path.join(self.directory, file_name)))
+       return sorted(snapshots)
+
+   def log_position(self, path):
+       # Mutation log position stored in the file name (None for snapshots written before it was)
+       parts = os.path.basename(path)[:-8].split("-")
+       return int(parts[2]) if len(parts) == 3 else None
+
+   def load_latest_before(self, timestamp):
+       self.wait()
+       candidates = [path for ts, path in self.list() if ts <= timestamp]
+       if not candidates:
+           return None
+       with gzip.open(candidates[-1], "rt") as f:
+           return json.load(f)
+
+# Change events published by ReservationSystem.events
+FlightAdded = namedtuple("FlightAdded", "flight")
+FlightChanged = namedtuple("FlightChanged", "flight")
+FlightDeleted = namedtuple("FlightDeleted", "code")
+BookingCreated = namedtuple("BookingCreated", "name code")
+BookingCancelled = namedtuple("BookingCancelled", "name code")
+DataReloaded = namedtuple("DataReloaded", "") # Everything may have changed, redraw from scratch
+
+# Tiny publish/subscribe bus so views don't have to call each other
+class EventBus:
+   def __init__(self):
+       self.subscribers = {} # Event type (None = every event) -> list of callbacks
+
+   def subscribe(self, event_type, callback):
+       self.subscribers.setdefault(event_type, []).append(callback)
+       return callback
+
+   def unsubscribe(self, event_type, callback):
+       if callback in self.subscribers.get(event_type, []):
+           self.subscribers[event_type].remove(callback)
+
+   def publish(self, event):
+       for callback in self.subscribers.get(type(event), []) + self.subscribers.get(None, []):
+           callback(event)
+
+# Composable flight search, e.g. system.query().to("Texas").departing(after="2030-01-01").with_seats(2).limit(5).
+# When it runs, a small planner picks the index that leaves the fewest candidates and streams
+# the matches from it; explain() shows the choice.
+class FlightQuery:
+   SORT_KEYS = {
+       "departure": lambda system, flight: parse_departure(flight.date_time) or datetime.max,
+       "code": lambda system, flight: flight.code,
+       "destination": lambda system, flight: flight.destination,
+       "seats": lambda system, flight: system._free_seats(flight.code),
+   }
+
+   def __init__(self, system):
+       self.system = system
+       self.code = None # Only this flight code
+       self.destination = None # Only flights to here
+       self.after = None # Earliest departure (datetime)
+       self.before = None # Latest departure (datetime)
+       self.min_seats = None # At least this many free seats
+       self.passenger = None # Only the flight this passenger is booked on
+       self.sort_key = None # One of SORT_KEYS
+       self.descending = False
+       self.max_results = None
+
+   def flight(self, code):
+       self.code = code
+       return self
+
+   def to(self, destination):
+       self.destination = destination
+       return self
+
+   def departing(self, after=None, before=None):
+       # Datetimes or "YYYY-MM-DD[ HH:MM]" strings; a date alone as "before" means the end of that day
+       if isinstance(after, str):
+           after = parse_departure(after)
+       if isinstance(before, str):
+           day_only = len(before.strip()) == 10
+           before = parse_departure(before)
+           if before is not None and day_only:
+               before += timedelta(days=1, microseconds=-1)
+       self.after, self.before = after, before
+       return self
+
+   def with_seats(self, seats=1):
+       self.min_seats = seats
+       return self
+
+   def booked_by(self, name):
+       self.passenger = name
+       return self
+
+   def order_by(self, key, descending=False):
+       if key not in self.SORT_KEYS:
+           raise ValueError(f"can't sort by {key!r}")
+       self.sort_key, self.descending = key, descending
+       return self
+
+   def limit(self, count):
+       self.max_results = count
+       return self
+
+   def plans(self):
+       # Every way to get candidates: (description, number of candidates, candidates, in departure order)
+       system = self.system
+       plans = [("full scan", len(system.flights), system.flights, False)]
+       if self.code is not None:
+           flight = system.flight_index.get(self.code)
+           plans.append(("code index", int(flight is not None), [flight] if flight else [], False))
+       if self.passenger is not None:
+           flight = system.flight_index.get(system.bookings.get(self.passenger))
+           plans.append(("passenger booking", int(flight is not None), [flight] if flight else [], False))
+       if self.destination is not None or self.after is not None or self.before is not None:
+           departures = system.departures_to(self.destination)
+           start = bisect.bisect_left(departures, (self.after, "")) if self.after else 0
+           end = bisect.bisect_right(departures, (self.before, "\U0010ffff")) if self.before else len(departures)
+           where = self.destination if self.destination is not None else "all destinations"
+           candidates = (system.flight_index[code] for _, code in itertools.islice(departures, start, max(end, start)))
+           plans.append((f"departure index ({where})", max(end - start, 0), candidates, True))
+       return plans
+
+   def plan(self):
+       # Cheapest plan; on a tie the more specific index wins
+       return min(reversed(self.plans()), key=lambda plan: plan[1])
+
+   def matches(self, flight):
+       system = self.system
+       if self.code is not None and flight.code != self.code:
+           return False
+       if self.destination is not None and flight.destination != self.destination:
+           return False
+       if self.after is not None or self.before is not None:
+           departure = parse_departure(flight.date_time)
+           if departure is None or (self.after and departure < self.after) or (self.before and departure > self.before):
+               return False
+       if self.passenger is not None and system.bookings.get(self.passenger) != flight.code:
+           return False
+       if self.min_seats is not None and system._free_seats(flight.code) < self.min_seats:
+           return False
+       return True
+
+   def __iter__(self):
+       _, _, candidates, by_departure = self.plan()
+       results = (flight for flight in candidates if self.matches(flight))
+       if self.sort_key is None or (self.sort_key == "departure" and by_departure and not self.descending):
+           return itertools.islice(results, self.max_results) # Streamed, no sorting needed
+       key = functools.partial(self.SORT_KEYS[self.sort_key], self.system)
+       if self.max_results is not None: # Keep only the best few instead of sorting everything
+           pick = heapq.nlargest if self.descending else heapq.nsmallest
+           return iter(pick(self.max_results, results, key=key))
+       return iter(sorted(results, key=key, reverse=self.descending))
+
+   def all(self):
+       return list(self)
+
+   def explain(self):
+       # How the query will run, one step per line
+       description, count, _, by_departure = self.plan()
+       lines = [f"index: {description} ({count} of {len(self.system.flights)} flights)"]
+       others = [f"{plan[0]} {plan[1]}" for plan in self.plans() if plan[0] != description]
+       if others:
+           lines.append("considered: " + ", ".join(others))
+       filters = []
+       if self.code is not None:
+           filters.append(f"code = {self.code}")
+       if self.destination is not None:
+           filters.append(f"destination = {self.destination}")
+       if self.after is not None:
+           filters.append(f"departure >= {self.after:%Y-%m-%d %H:%M}")
+       if self.before is not None:
+           filters.append(f"departure <= {self.before:%Y-%m-%d %H:%M}")
+       if self.passenger is not None:
+           filters.append(f"passenger = {self.passenger}")
+       if self.min_seats is not None:
+           filters.append(f"free seats >= {self.min_seats}")
+       lines.append("filter: " + (", ".join(filters) if filters else "none"))
+       if self.sort_key is None:
+           lines.append("order: as found")
+       elif self.sort_key == "departure" and by_departure and not self.descending:
+           lines.append("order: departure (index order, streamed)")
+       else:
+           lines.append(f"order: {self.sort_key}{' descending' if self.descending else ''} "
+                        f"({'top ' + str(self.max_results) + ' kept' if self.max_results is not None else 'sorted'})")
+       if self.max_results is not None:
+           lines.append(f"limit: {self.max_results}")
+       return "\n".join(lines)
+
+# Looks for orphan bookings, duplicate flight codes, over-capacity flights and unreadable
+# departure times. Flights and bookings are split into segments by flight code, so every check
+# stays inside one segment; a checksum per segment is saved and only segments whose checksum
+# changed are verified again. If no data file changed since the last check nothing is read at all.
+class IntegrityChecker:
+   def __init__(self, system, segments=INTEGRITY_SEGMENTS):
+       self.system = system
+       self.segments = segments
+       self.checksums = {} # Segment -> checksum when it was last verified
+       self.problems = {} # Segment -> problems found in it then
+       self.signatures = None # Data file signatures at the last check
+       self.dirty = set() # Segments changed in this process since the last check
+       self.segments_checked = 0 # Segments verified by the last check
+       self.verified = False # After the first check, changes (ours or replayed) all come in as events
+       system.events.subscribe(None, self._on_event)
+
+   def segment_of(self, code):
+       return zlib.crc32(code.encode("utf-8")) % self.segments
+
+   def _on_event(self, event):
+       if isinstance(event, DataReloaded):
+           self.dirty.update(range(self.segments)) # Checksums tell which ones really changed
+       elif isinstance(event, (FlightAdded, FlightChanged)):
+           self.dirty.add(self.segment_of(event.flight.code))
+       else:
+           self.dirty.add(self.segment_of(event.code))
+
+   def load(self):
+       storage = self.system.storage
+       if not storage.exists(INTEGRITY_FILE):
+           return False
+       data = storage.read_json(INTEGRITY_FILE)
+       if data.get("segments") != self.segments:
+           return False # Different split, start over
+       self.checksums = {int(segment): value for segment, value in data["checksums"].items()}
+       self.problems = {int(segment): problems for segment, problems in data["problems"].items()}
+       self.signatures = data["signatures"]
+       return True
+
+   def save(self):
+       self.system.storage.write_json(INTEGRITY_FILE, {"segments": self.segments, "signatures": self.signatures,
+                                                      "checksums": self.checksums, "problems": self.problems}, atomic=True)
+
+   def file_signatures(self):
+       # None when the bookings live in files the signatures don't cover (shards, binary store)
+       system = self.system
+       if system.shard_store or system.binary_store is not None:
+           return None
+       return [list(signature) if signature else None
+               for signature in map(system.storage.signature, ("flights.json", "bookings.json", "schedules.json"))]
+
+   def contents(self, segments):
+       # Segment -> (flights, flight code -> passenger names) for the given segments
+       if not segments:
+           return {} # Nothing changed, don't build the passenger index
+       system = self.system
+       contents = {segment: ([], {}) for segment in segments}
+       for flight in system.flights:
+           segment = self.segment_of(flight.code)
+           if segment in contents:
+               contents[segment][0].append(flight)
+       decode = system.passenger_ids.decode
+       for flight, passengers in system.passenger_index().items():
+           code = system.flight_ids.decode(flight)
+           segment = self.segment_of(code)
+           if segment in contents and passengers:
+               contents[segment][1][code] = [decode(passenger) for passenger in passengers]
+       return contents
+
+   def checksum(self, flights, booked):
+       # crc32 of the flights plus an order-free sum over the bookings (no sorting needed)
+       total = zlib.crc32(json.dumps([flight.to_dict() for flight in flights]).encode("utf-8"))
+       for code, names in booked.items():
+           for name in names:
+               total += zlib.crc32(f"{name}\t{code}".encode("utf-8"))
+       return total & 0xFFFFFFFFFFFFFFFF
+
+   def verify(self, flights, booked):
+       system = self.system
+       problems = []
+       seen = {}
+       for flight in flights:
+           seen[flight.code] = seen.get(flight.code, 0) + 1
+           if parse_departure(flight.date_time) is None:
+               problems.append({"type": "bad_date_time", "code": flight.code, "date_time": flight.date_time})
+       for code, count in seen.items():
+           if count > 1:
+               problems.append({"type": "duplicate_flight", "code": code, "count": count})
+       for code, names in sorted(booked.items()):
+           flight = system.flight_index.get(code)
+           if flight is None and system.get_flight(code) is None:
+               problems.extend({"type": "orphan_booking", "name": name, "code": code} for name in sorted(names))
+           elif flight is not None and len(names) > flight.capacity:
+               problems.append({"type": "over_capacity", "code": code, "booked": len(names), "capacity": flight.capacity})
+       return problems
+
+   def check(self, full=False):
+       # Verify the segments that changed (every segment with full=True); returns all known problems
+       system = self.system
+       with system.lock:
+           signatures = self.file_signatures()
+           if full or (not self.verified and (signatures is None or signatures != self.signatures)):
+               segments = range(self.segments) # Files changed since the last run, so compare every checksum
+           else:
+               segments = set(self.dirty)
+           checked = 0
+           for segment, (flights, booked) in self.contents(segments).items():
+               checksum = self.checksum(flights, booked)
+               if not full and self.checksums.get(segment) == checksum:
+                   continue
+               self.checksums[segment] = checksum
+               problems = self.verify(flights, booked)
+               if problems:
+                   self.problems[segment] = problems
+               else:
+                   self.problems.pop(segment, None)
+               checked += 1
+           self.dirty.clear()
+           self.verified = True
+           changed = checked or signatures != self.signatures
+           self.signatures = signatures
+           self.segments_checked = checked
+           if changed and not system.read_only:
+               self.save()
+           return self.report()
+
+   def report(self):
+       return [problem for segment in sorted(self.problems) for problem in self.problems[segment]]
+
+# One line per problem for the CLI and the startup warning
+def describe_problem(problem):
+   if problem["type"] == "orphan_booking":
+       return f"{problem['name']} is booked on {problem['code']}, which doesn't exist"
+   if problem["type"] == "duplicate_flight":
+       return f"flight {problem['code']} is listed {problem['count']} times"
+   if problem["type"] == "over_capacity":
+       return f"flight {problem['code']} has {problem['booked']} bookings for {problem['capacity']} seats"
+   return f"flight {problem['code']} has an unreadable departure time {problem['date_time']!r}"
+
+_MISSING = object() # Marker so a cached "no booking" is different from a cache miss
+
 # Reservation system class to manage all bookings and flights
 class ReservationSystem:
-   def __init__(self):
+   def __init__(self, cache_size=256, booking_shards=None, instrument=False, shared=False, auto_archive=False,
+                snapshot_interval=None, binary_bookings=False, trace=None, replica=False, data_dir=".", storage=None,
+                check_integrity=True):
+       self.storage = storage if storage is not None else FileStorage(data_dir) # Where the data files live (MemoryStorage for none at all)
+       self.metrics = MetricsRegistry(enabled=instrument) # Timings of every operation, off unless asked for
+       self.trace = TraceRecorder(self.output_path(TRACE_FILE) if trace is True else trace) if trace else None # Optional operation trace
        self.flights = [] # List to store all flights
-       self.bookings = {} # Dictionary to store user bookings
+       self.passenger_ids = Interner() # Passenger name <-> integer id used by the indexes
+       self.flight_ids = Interner() # Flight code <-> integer id used by the indexes
+       self.bookings = EncodedBookings(self.passenger_ids, self.flight_ids) # Passenger name -> flight code, stored as ids
+       self.flight_index = {} # Flight code -> Flight object for fast lookups
+       self._flight_passengers = None # Flight id -> set of passenger ids booked on it, built when first needed
+       self.lookup_cache = LRUCache(cache_size) # Passenger name -> booked Flight (or None)
+       self.fragment_cache = LRUCache(cache_size) # Flight code -> formatted report text
+       self.schedules = {} # Route code -> ScheduleRule for recurring departures
+       self.instance_cache = LRUCache(cache_size) # Departure code -> Flight built from a rule but not booked yet
+       self.flights_signature = None # (mtime, size) of flights.json when we last read or wrote it
+       self.lock = TimedLock(self.metrics, "lock_wait") # Guards seat counts so two clerks can't take the last seat
+       self.holds = {} # Hold id -> (name, flight code)
+       self.held_seats = {} # Flight code -> number of seats on hold
+       self.hold_timers = TimerWheel() # Expiry times of the holds
+       self.hold_ids = itertools.count(1) # Next hold number
+       self.shard_store = ShardedBookingStore(self.storage.path("booking_shards"), booking_shards, self.metrics) if booking_shards and not binary_bookings else None # Optional sharded storage
+       self.binary_store = BinaryBookingStore(self.storage.path("bookings")) if binary_bookings else None # Optional memory-mapped storage
+       self.waitlists = {} # Flight code -> Waitlist
+       self.waitlist_sequence = itertools.count() # Tie breaker for requests made at the same time
+       self.waitlist_log_lines = 0 # Lines in waitlists.jsonl, used to decide when to compact
+       self.waitlisted = 0 # Passengers waiting on all flights, so the compaction check needs no sum
+       self.events = EventBus() # Change events for views and other listeners
+       self.data_version = 0 # Goes up on every change to flights or bookings, so views know when to redraw
+       self.departure_index = None # Destination -> sorted (departure, code) list, built when needed
+       self.fares = FareEngine(self) # Prices for quotes
+       self.name_index = TrigramIndex() # Passenger names for fuzzy search, kept in sync by events
+       self.name_index_stale = True # Filled from the bookings on the first search after a reload
+       self.events.subscribe(BookingCreated, self._index_name)
+       self.events.subscribe(BookingCancelled, self._index_name)
+       self.writer_id = f"{os.getpid()}-{id(self)}" # Tells our own log entries apart from other processes
+       self.read_only = replica # A replica only follows the mutation log of the other processes
+       self.replaying = replica # True while applying changes made by another process (always, for a replica)
+       self.synced_at = time.time() # When the last sync started; everything logged before it is applied
+       self.follower = None # Background thread of a following replica
+       self.follow_stop = threading.Event()
+       self.pending_mutations = [] # Changes made here that still have to go to the mutation log
+       shared = shared or snapshot_interval is not None or replica # Snapshots and replicas need the mutation log
+       if replica:
+           snapshot_interval, auto_archive = None, False # Those write files
+       if shared and binary_bookings:
+           raise ValueError("the binary booking store can't be shared between processes")
+       self.process_lock = FileLock(self.storage.path("reservations.lock")) if shared else None # Only when several apps share the files
+       self.mutation_log = MutationLog(self.storage.path("mutations.jsonl")) if shared else None
+       self.snapshots = SnapshotManager(self.storage.path("snapshots"), snapshot_interval) if snapshot_interval is not None else None
+       if shared:
+           with self.process_lock: # Nobody may write while we read the files
+               self._load_all()
+               self.mutation_log.skip_to_end()
+               if self.snapshots and not self.snapshots.list():
+                   self.snapshots.take(self, background=False) # First base to restore from
+       else:
+           self._load_all()
+       if auto_archive:
+           self.archive_departed() # Keep only future flights in the working files
+       self.integrity = IntegrityChecker(self) # Watches changes from here on
+       self.integrity.load()
+       self.integrity_problems = []
+       if check_integrity and self.binary_store is None: # The binary store opens without reading the bookings
+           self.integrity_problems = self.integrity.check() # Only reads data that changed since the last check
+
+   def _load_all(self):
        self.load_flights() # Load flights into the list
+       self.load_schedules() # Load recurring departures
        self.load_bookings() # Load previous bookings if any
+       self.load_waitlists() # Load people waiting for full flights
+       self.recover_transaction() # Finish a bulk change that was cut off
  
+   @instrumented("load_flights")
    def load_flights(self):
        # Load flights from file if it exists
-       if os.path.exists("flights.json"):
-           with open("flights.json", "r") as f:
-               flights_data = json.load(f)
-               self.flights = [Flight(f["code"], f["destination"], f["date_time"]) for f in flights_data]
+       if self.storage.exists("flights.json"):
+           flights_data = self.storage.read_json("flights.json")
+           self.flights = [flight_from_dict(f) for f in flights_data]
        else:
            # If no file, start with 3 default flights
            self.flights = [
@@ -35,80 +1948,1089 @@ class ReservationSystem:
                Flight("TX456", "Texas", "2025-05-02 14:30"),
                Flight("NY789", "New York", "2025-05-03 18:00")
            ]
-           self.save_flights() # Save them to file
+           if not self.read_only:
+               self.save_flights() # Save them to file
+       self.flights_signature = self._flights_file_signature()
+       self.rebuild_flight_index()
  
+   @instrumented("save_flights")
    def save_flights(self):
        # Save all flights to a file so they don't get lost after closing
-       with open("flights.json", "w") as f:
-           flights_data = [{"code": flight.code, "destination": flight.destination, "date_time": flight.date_time} for flight in self.flights]
-           json.dump(flights_data, f)
+       flights_data = [flight.to_dict() for flight in self.flights]
+       self.storage.write_json("flights.json", flights_data)
+       self.flights_signature = self._flights_file_signature() # So the file watcher skips our own write
+
+   def _flights_file_signature(self):
+       return self.storage.signature("flights.json")
+
+   def check_flights_file(self):
+       # Cheap poll for a flights.json written by someone else (e.g. the schedule team).
+       # Returns the applied diff, or None if the file didn't change.
+       if self.read_only or self._flights_file_signature() == self.flights_signature:
+           return None
+       return self.reload_flights()
+
+   @instrumented("reload_flights")
+   @shared_write
+   def reload_flights(self):
+       # Apply the differences between flights.json and memory flight by flight, so indexes
+       # and open lists only change for the flights that changed.
+       # Returns {"added": [...], "changed": [...], "removed": [...]} (flight codes).
+       with self.lock:
+           signature = self._flights_file_signature()
+           if signature is None:
+               return None # File removed, keep what we have
+           wanted = {}
+           for data in self.storage.read_json("flights.json"):
+               wanted.setdefault(data["code"], flight_from_dict(data)) # First one wins, like the index
+           self.flights_signature = signature
+           diff = {"added": [], "changed": [], "removed": []}
+           for code, new in wanted.items():
+               flight = self.flight_index.get(code)
+               if flight is None:
+                   self._insert_flight(new)
+                   diff["added"].append(code)
+               elif flight.to_dict() != new.to_dict():
+                   self._update_flight(flight, new)
+                   diff["changed"].append(code)
+           removed = [code for code in self.flight_index if code not in wanted]
+           booked = [code for code in removed if self.booked_count(code)]
+           for code in removed:
+               if code not in booked:
+                   self._remove_flight(code)
+                   self._drop_waitlist(code)
+           for code in booked:
+               self.cancel_flight(code) # Passengers move to later flights or the waitlist; saves the files
+           diff["removed"] = removed
+           if booked:
+               self.flights_signature = self._flights_file_signature()
+           return diff
+
+   def _update_flight(self, flight, new):
+       # Copy new details onto the Flight object that views and caches already hold
+       self._record("update_flight", flight=new.to_dict())
+       flight.destination, flight.date_time = new.destination, new.date_time
+       flight.capacity, flight.base_fare = new.capacity, new.base_fare
+       flight.fare_table = None
+       self._invalidate_flight(flight.code)
+       self.events.publish(FlightChanged(flight))
  
+   @instrumented("load_bookings")
    def load_bookings(self):
        # Load bookings from the JSON file if it exists
-       if os.path.exists("bookings.json"):
-           with open("bookings.json", "r") as f:
-               self.bookings = json.load(f)
-
+       self.passenger_ids, self.flight_ids = Interner(), Interner() # Fresh ids, so names and codes no longer used are gone
+       if self.binary_store is not None and self.binary_store.exists():
+           self.bookings = self.binary_store.open() # Nothing is read until it is looked up
+           self.rebuild_booking_index()
+           return
+       data = None
+       if self.storage.exists("bookings.json"):
+           data = self.storage.read_json("bookings.json")
+       self.bookings = EncodedBookings(self.passenger_ids, self.flight_ids, data) # Reads the old name -> code layout too
+       if self.binary_store is not None:
+           self.bookings = self.binary_store.open(self.bookings) # First run in binary mode imports the JSON file
+       if self.shard_store:
+           self.bookings = EncodedBookings(self.passenger_ids, self.flight_ids, self.shard_store.load(self.bookings)) # Shards win once they exist
+       self.rebuild_booking_index()
+
+   def rebuild_flight_index(self):
+       # Map every code to its flight (first one wins, like the old linear search)
+       self.flight_index = {}
+       for flight in self.flights:
+           self.flight_index.setdefault(flight.code, flight)
+       self.departure_index = None
+       self.data_version += 1
+       self.lookup_cache.clear()
+       self.fragment_cache.clear()
+       self.instance_cache.clear()
+       self.events.publish(DataReloaded())
+
+   def rebuild_booking_index(self):
+       # Forget the derived indexes; they are rebuilt from the bookings when first needed
+       self._flight_passengers = None
+       self.name_index_stale = True
+       self.data_version += 1
+       self.lookup_cache.clear()
+       self.events.publish(DataReloaded())
+
+   @instrumented("load_waitlists")
+   def load_waitlists(self):
+       # Replay the waitlist change log; each line is one join or leave
+       self.waitlists = {}
+       self.waitlisted = 0
+       self.waitlist_log_lines = 0
+       if not self.storage.exists("waitlists.jsonl"):
+           return
+       for line in self.storage.read_lines("waitlists.jsonl"):
+           if not line.strip():
+               continue
+           self.waitlist_log_lines += 1
+           self._apply_waitlist_change(json.loads(line))
+
+   def _apply_waitlist_change(self, change):
+       if change["op"] == "join":
+           if self.waitlists.setdefault(change["code"], Waitlist()).add(
+                   change["name"], change["priority"], change["time"], next(self.waitlist_sequence)):
+               self.waitlisted += 1
+       elif change["code"] in self.waitlists and self.waitlists[change["code"]].remove(change["name"]):
+           self.waitlisted -= 1
+
+   def _log_waitlist(self, change):
+       # Append one change instead of rewriting every waitlist
+       self._record("waitlist", change=change)
+       self.storage.append_lines("waitlists.jsonl", [json.dumps(change) + "\n"])
+       self.waitlist_log_lines += 1
+       if self.waitlist_log_lines > 2 * self.waitlisted + 64:
+           self.compact_waitlists()
+
+   @instrumented("compact_waitlists")
+   @shared_write
+   def compact_waitlists(self):
+       # Rewrite the log so it only holds people who are still waiting
+       lines = []
+       for code, waitlist in self.waitlists.items():
+           for entry in waitlist.order:
+               lines.append(json.dumps({"op": "join", "code": code, "name": entry[3], "priority": -entry[0], "time": entry[1]}) + "\n")
+       self.storage.write_lines("waitlists.jsonl", lines)
+       self.waitlist_log_lines = self.waitlisted
+
+   @instrumented("save_bookings")
    def save_bookings(self):
        # Save bookings to the file so we don't lose them
-       with open("bookings.json", "w") as f:
-           json.dump(self.bookings, f)
+       self._maybe_compact_ids()
+       if self.shard_store:
+           self.shard_store.flush() # Only the shards that changed are written
+           return
+       if self.binary_store is not None:
+           self.binary_store.flush() # Records were already changed in place
+           return
+       self.storage.write_json("bookings.json", self.bookings.to_json())
+
+   def _record(self, op, **fields):
+       # Remember a change for the mutation log (only in shared mode, and not for replayed changes)
+       if self.mutation_log is not None and not self.replaying:
+           fields["op"] = op
+           fields["ts"] = time.time()
+           fields["writer"] = self.writer_id
+           self.pending_mutations.append(fields)
+
+   def _flush_mutations(self):
+       if self.pending_mutations:
+           self.mutation_log.append(self.pending_mutations)
+           self.pending_mutations = []
+
+   @instrumented("sync")
+   def sync(self):
+       # Apply changes other processes logged since we last looked; returns how many were applied
+       started = time.time()
+       applied = self._sync()
+       self.synced_at = started
+       if self.read_only and self.holds:
+           self._expire_replayed_holds()
+       return applied
+
+   def _sync(self):
+       if self.mutation_log is None or not self.mutation_log.changed():
+           return 0
+       with self.lock:
+           entries = self.mutation_log.read_new()
+           if entries is None: # Log was replaced, start over from the files
+               with self.process_lock:
+                   self._load_all()
+                   self.mutation_log.skip_to_end()
+               return 1
+           applied = 0
+           for entry in entries:
+               if entry.get("writer") == self.writer_id:
+                   continue
+               if entry["op"] == "reload": # Another process restored a snapshot
+                   with self.process_lock:
+                       self._load_all()
+                       self.mutation_log.skip_to_end()
+                   return applied + 1
+               self._apply_mutation(entry)
+               applied += 1
+           return applied
+
+   def follow(self, interval=REPLICA_POLL):
+       # Keep applying other processes' changes on a background thread, so this copy is never
+       # more than about interval seconds behind even when nobody reads from it
+       if self.follower is None:
+           self.follow_stop.clear()
+           self.follower = threading.Thread(target=self._follow_loop, args=(interval,), daemon=True)
+           self.follower.start()
+
+   def _follow_loop(self, interval):
+       while not self.follow_stop.wait(interval):
+           self.sync()
+
+   def stop_following(self):
+       if self.follower is not None:
+           self.follow_stop.set()
+           self.follower.join()
+           self.follower = None
+
+   def lag(self):
+       # Seconds of logged changes that may not be applied here yet (0 when caught up)
+       if self.mutation_log is None or not self.mutation_log.changed():
+           return 0.0
+       return time.time() - self.synced_at
+
+   def _apply_mutation(self, entry):
+       # Repeat one logged change in memory only (the writer already saved the files)
+       was_replaying, self.replaying = self.replaying, True
+       try:
+           op = entry["op"]
+           if op == "book":
+               self._set_booking(entry["name"], entry["code"])
+           elif op == "cancel":
+               if entry["name"] in self.bookings:
+                   self._drop_booking(entry["name"])
+           elif op == "add_flight":
+               self._insert_flight(flight_from_dict(entry["flight"]))
+           elif op == "delete_flight":
+               if entry["code"] in self.flight_index:
+                   self._remove_flight(entry["code"])
+                   self.waitlisted -= len(self.waitlists.pop(entry["code"], ()))
+           elif op == "reschedule":
+               flight = self.get_flight(entry["code"])
+               if flight:
+                   self._retime_flight(flight, entry["date_time"])
+           elif op == "waitlist":
+               self._apply_waitlist_change(entry["change"])
+           elif op == "hold":
+               remaining = entry["ttl"] - (time.time() - entry["ts"]) # Monotonic clocks differ between processes
+               if remaining > 0:
+                   self._add_hold((entry["writer"], entry["hold"]), entry["name"], entry["code"], time.monotonic() + remaining)
+           elif op == "release":
+               self._pop_hold((entry["writer"], entry["hold"]))
+           elif op == "update_flight":
+               flight = self.flight_index.get(entry["flight"]["code"])
+               if flight:
+                   self._update_flight(flight, flight_from_dict(entry["flight"]))
+           elif op == "add_schedule":
+               self._insert_schedule(rule_from_dict(entry["rule"]))
+           elif op == "remove_schedule":
+               if entry["code"] in self.schedules:
+                   self._delete_schedule(entry["code"])
+       finally:
+           self.replaying = was_replaying
+
+   @instrumented("restore_to")
+   def restore_to(self, timestamp):
+       # Put flights, bookings and waitlists back the way they were at a Unix time
+       if self.snapshots is None:
+           return False
+       with self.lock, self.process_lock:
+           self.sync()
+           snapshot = self.snapshots.load_latest_before(timestamp)
+           if snapshot is None:
+               return False # Nothing saved that early
+           self.replaying = True
+           try:
+               self.flights = [flight_from_dict(data) for data in snapshot["flights"]]
+               self.rebuild_flight_index()
+               self.passenger_ids, self.flight_ids = Interner(), Interner()
+               self.bookings = EncodedBookings(self.passenger_ids, self.flight_ids, snapshot["bookings"])
+               self.rebuild_booking_index()
+               self.waitlists = {}
+               self.waitlisted = 0
+               for code, rows in snapshot["waitlists"].items():
+                   for name, priority, request_time in rows:
+                       self._apply_waitlist_change({"op": "join", "code": code, "name": name, "priority": priority, "time": request_time})
+               # Only the log written since that snapshot is replayed, so restore time is bounded by the interval
+               for entry in self.mutation_log.read_range(snapshot["log_offset"], timestamp):
+                   if entry["op"] not in ("reload", "hold", "release"): # Holds are not part of the saved state
+                       self._apply_mutation(entry)
+           finally:
+               self.replaying = False
+           self.save_flights()
+           if self.shard_store:
+               self.shard_store.replace_all(self.bookings)
+           else:
+               self.save_bookings()
+           self.compact_waitlists()
+           self._record("reload") # Tell other processes to reload the files
+           self._flush_mutations()
+           self.snapshots.take(self, background=False) # New base so later restores don't cross the reload
+           return True
+
+   def query(self):
+       # Start a FlightQuery over the saved flights
+       self.sync()
+       return FlightQuery(self)
 
+   @instrumented("get_flight")
    def get_flight(self, code):
        # Find a flight object by its code
-       for flight in self.flights:
-           if flight.code == code:
-               return flight
-       return None # If not found, return nothing
+       flight = self.flight_index.get(code)
+       if flight is None and self.schedules:
+           flight = self._scheduled_flight(code) # A departure of a schedule rule that isn't booked yet
+       return flight # None if not found
+
+   def _scheduled_flight(self, code):
+       # Flight for a "ROUTE-YYYYMMDD" code, None if no rule flies that day
+       route, _, day = code.rpartition("-")
+       rule = self.schedules.get(route)
+       if rule is None:
+           return None
+       flight = self.instance_cache.get(code)
+       if flight is None:
+           day = parse_departure(f"{day[:4]}-{day[4:6]}-{day[6:]}") if len(day) == 8 and day.isdigit() else None
+           if day is None or not rule.runs_on(day):
+               return None
+           flight = rule.flight_on(day)
+           self.instance_cache.put(code, flight) # Same object every time, so fares and views can keep it
+       return flight
+
+   def _materialize(self, code):
+       # A scheduled departure becomes a saved Flight the first time something changes it
+       if code in self.flight_index or not self.schedules:
+           return
+       flight = self._scheduled_flight(code)
+       if flight is not None:
+           self.instance_cache.invalidate(code)
+           self._insert_flight(flight)
+           self.save_flights()
+
+   def bookable_flights(self, now=None, days=SCHEDULE_HORIZON):
+       # Saved flights plus the scheduled departures of the next few days that aren't saved yet
+       now = now or datetime.now()
+       flights = list(self.flights)
+       for rule in self.schedules.values():
+           for flight in rule.instances(now, now + timedelta(days=days)):
+               if flight.code not in self.flight_index and parse_departure(flight.date_time) >= now:
+                   flights.append(self._scheduled_flight(flight.code))
+       return flights
+
+   @instrumented("load_schedules")
+   def load_schedules(self):
+       self.schedules = {}
+       if self.storage.exists("schedules.json"):
+           self.schedules = {data["code"]: rule_from_dict(data) for data in self.storage.read_json("schedules.json")}
+       self.instance_cache.clear()
+
+   def save_schedules(self):
+       self.storage.write_json("schedules.json", [rule.to_dict() for rule in self.schedules.values()], atomic=True)
+
+   @instrumented("add_schedule")
+   @shared_write
+   def add_schedule(self, code, destination, time_of_day, start, end, weekdays=None, exceptions=()):
+       # Recurring departures from start to end ("YYYY-MM-DD"); returns the rule or None
+       with self.lock:
+           if not code or code in self.schedules or parse_departure(f"{start} {time_of_day}") is None or parse_departure(end) is None:
+               return None
+           rule = ScheduleRule(code, destination, time_of_day, start, end, weekdays, exceptions)
+           self._insert_schedule(rule)
+           self.save_schedules()
+           return rule
+
+   def _insert_schedule(self, rule):
+       self._record("add_schedule", rule=rule.to_dict())
+       self.schedules[rule.code] = rule
+       self.instance_cache.clear()
+       self.data_version += 1
+       self.events.publish(DataReloaded()) # Lists of bookable flights change
+
+   @instrumented("remove_schedule")
+   @shared_write
+   def remove_schedule(self, code):
+       # Stop offering the departures of a rule; ones already booked stay as normal flights
+       with self.lock:
+           if code not in self.schedules:
+               return False
+           self._delete_schedule(code)
+           self.save_schedules()
+           return True
+
+   def _delete_schedule(self, code):
+       self._record("remove_schedule", code=code)
+       del self.schedules[code]
+       self.instance_cache.clear()
+       self.data_version += 1
+       self.events.publish(DataReloaded())
+
+   @instrumented("check_integrity")
+   def check_integrity(self, full=False):
+       # Problems in the data (see IntegrityChecker); only changed segments are verified unless full
+       self.sync()
+       self.integrity_problems = self.integrity.check(full)
+       return self.integrity_problems
+
+   def compact_ids(self):
+       # Number passengers and flights again from the live bookings. Ids are never reused, so
+       # after many cancels most of the interners and the flight_of column are dead entries.
+       if not isinstance(self.bookings, EncodedBookings):
+           return False
+       with self.lock:
+           bookings = dict(self.bookings.items())
+           self.passenger_ids, self.flight_ids = Interner(), Interner()
+           self.bookings = EncodedBookings(self.passenger_ids, self.flight_ids, bookings)
+           self._flight_passengers = None # Held the old ids
+           return True
 
+   def _maybe_compact_ids(self):
+       if isinstance(self.bookings, EncodedBookings) and \
+               len(self.passenger_ids) + len(self.flight_ids) > 2 * (len(self.bookings) + len(self.flight_index)) + 1024:
+           self.compact_ids()
+
+   def booking_ids(self):
+       # (passenger id, flight id) of every booking
+       if isinstance(self.bookings, EncodedBookings):
+           return self.bookings.ids()
+       return ((self.passenger_ids.encode(name), self.flight_ids.encode(code)) for name, code in self.bookings.items())
+
+   def passenger_index(self):
+       # Flight id -> set of passenger ids, grouped from the bookings on first use
+       if self._flight_passengers is None:
+           index = {}
+           for passenger, flight in self.booking_ids():
+               index.setdefault(flight, set()).add(passenger)
+           self._flight_passengers = index
+       return self._flight_passengers
+
+   def passengers_on(self, code):
+       # Names of the passengers booked on a flight
+       flight = self.flight_ids.lookup(code)
+       decode = self.passenger_ids.decode
+       return [decode(passenger) for passenger in self.passenger_index().get(flight, ())]
+
+   def booked_count(self, code):
+       # Seats sold on a flight; the binary store keeps counts, so no passenger index is needed
+       if self._flight_passengers is None and self.binary_store is not None:
+           return self.binary_store.count(code)
+       return len(self.passenger_index().get(self.flight_ids.lookup(code), ()))
+
+   def _set_booking(self, name, code):
+       # Every new or changed booking goes through here so the indexes stay in sync
+       if not self.replaying:
+           self._materialize(code) # Booking a scheduled departure saves it as a flight
+       old_code = self.bookings.get(name)
+       passenger, flight = self.passenger_ids.encode(name), self.flight_ids.encode(code)
+       if old_code is not None and self._flight_passengers is not None:
+           self._flight_passengers.get(self.flight_ids.lookup(old_code), set()).discard(passenger)
+       if self.shard_store:
+           self.shard_store.put(name, code, old_code, written=self.replaying) # Replayed changes keep the shards current for compaction
+       self._record("book", name=name, code=code)
+       self.bookings[name] = code
+       if self._flight_passengers is not None:
+           self._flight_passengers.setdefault(flight, set()).add(passenger)
+       self.lookup_cache.invalidate(name)
+       self.data_version += 1
+       if old_code is not None and old_code != code:
+           self.events.publish(BookingCancelled(name, old_code))
+       self.events.publish(BookingCreated(name, code))
+
+   def _drop_booking(self, name):
+       # Every removed booking goes through here so the indexes stay in sync
+       code = self.bookings.pop(name)
+       if self.shard_store:
+           self.shard_store.remove(name, code, written=self.replaying)
+       self._record("cancel", name=name)
+       flight = self.flight_ids.lookup(code)
+       passengers = self._flight_passengers.get(flight) if self._flight_passengers is not None else None
+       if passengers is not None:
+           passengers.discard(self.passenger_ids.lookup(name))
+           if not passengers:
+               del self._flight_passengers[flight]
+       self.lookup_cache.invalidate(name)
+       self.data_version += 1
+       self.events.publish(BookingCancelled(name, code))
+       return code
+
+   def _invalidate_flight(self, code):
+       # A flight changed, so forget its report text and the lookups of its passengers
+       self.data_version += 1
+       self.departure_index = None
+       self.fragment_cache.invalidate(code)
+       if self._flight_passengers is None:
+           self.lookup_cache.clear() # Cheaper than building the passenger index
+           return
+       for name in self.passengers_on(code):
+           self.lookup_cache.invalidate(name)
+
+   @instrumented("book_flight")
+   @shared_write
    def book_flight(self, name, code):
-       flight = self.get_flight(code) # Look up the flight
-       if name and flight:
-           self.bookings[name] = code # Save the booking
-           self.save_bookings() # Write to file
-           return flight # Return the flight object
-       return None # If something went wrong
+       with self._booking_change():
+           self.expire_holds()
+           flight = self.get_flight(code) # Look up the flight
+           if name and flight:
+               if self.bookings.get(name) != code and self._free_seats(code) <= 0:
+                   return None # Flight is full
+               old_code = self.bookings.get(name)
+               self._set_booking(name, code) # Save the booking
+               if old_code is not None and old_code != code:
+                   self._promote_waitlist(old_code) # The old seat is free now
+               self._save_booking_change() # Write to file
+               return flight # Return the flight object
+           return None # If something went wrong
+
+   @contextmanager
+   def _booking_change(self):
+       # The global lock covers the seat check and the change in memory. Booking shards are
+       # written after it is released, each under its own shard lock, so bookings on other
+       # shards don't wait for the file write. Only within one process: in shared mode
+       # shared_write holds the global lock and reservations.lock for the whole call, so
+       # writes from every thread and process still go one at a time.
+       with self.lock:
+           yield
+           self._maybe_compact_ids()
+       if self.shard_store:
+           self.shard_store.flush()
+
+   def _save_booking_change(self):
+       # Inside _booking_change: a single bookings file is written under the global lock,
+       # shards are left for _booking_change to flush
+       if not self.shard_store:
+           self.save_bookings()
+
+   @instrumented("seats_left")
+   def seats_left(self, code, now=None):
+       # Free seats = capacity - booked - held
+       with self.lock:
+           if self.read_only:
+               self._expire_replayed_holds(now)
+           else:
+               self.expire_holds(now)
+           return self._free_seats(code)
 
+   def _free_seats(self, code):
+       flight = self.get_flight(code)
+       if not flight:
+           return 0
+       return flight.capacity - self.booked_count(code) - self.held_seats.get(code, 0)
+
+   @instrumented("hold_seat")
+   @shared_write
+   def hold_seat(self, name, code, ttl=HOLD_TTL, now=None):
+       # Keep a seat aside for a while; returns a hold id, or None if the flight is full
+       now = time.monotonic() if now is None else now
+       with self.lock:
+           self.expire_holds(now)
+           if not name or self._free_seats(code) <= 0:
+               return None
+           hold_id = next(self.hold_ids)
+           self._record("hold", hold=hold_id, name=name, code=code, ttl=ttl) # Other counters count the seat as taken too
+           self._add_hold(hold_id, name, code, now + ttl)
+           return hold_id
+
+   def _add_hold(self, hold_id, name, code, deadline):
+       # Our holds are keyed by number, holds replayed from other processes by (writer, number)
+       self.holds[hold_id] = (name, code)
+       self.held_seats[code] = self.held_seats.get(code, 0) + 1
+       self.hold_timers.schedule(hold_id, deadline)
+
+   @instrumented("confirm_hold")
+   @shared_write
+   def confirm_hold(self, hold_id, now=None):
+       # Turn a hold into a booking; returns the flight, or None if the hold expired
+       with self._booking_change():
+           self.expire_holds(now)
+           hold = self._pop_hold(hold_id)
+           if hold is None:
+               return None
+           name, code = hold
+           old_code = self.bookings.get(name)
+           if old_code != code and self._free_seats(code) <= 0:
+               return None # Flight was filled or removed in the meantime
+           self._set_booking(name, code)
+           if old_code is not None and old_code != code:
+               self._promote_waitlist(old_code) # The old seat is free now
+           self._save_booking_change()
+           return self.get_flight(code)
+
+   @instrumented("release_hold")
+   @shared_write
+   def release_hold(self, hold_id):
+       # Give a held seat back
+       with self.lock:
+           hold = self._pop_hold(hold_id)
+           if hold is None:
+               return False
+           if self._promote_waitlist(hold[1]):
+               self.save_bookings()
+           return True
+
+   def _pop_hold(self, hold_id):
+       hold = self.holds.pop(hold_id, None)
+       if hold is not None:
+           if not isinstance(hold_id, tuple):
+               self._record("release", hold=hold_id)
+           self.hold_timers.cancel(hold_id)
+           self._free_held_seat(hold[1])
+       return hold
+
+   def _free_held_seat(self, code):
+       count = self.held_seats.get(code, 0) - 1
+       if count > 0:
+           self.held_seats[code] = count
+       else:
+           self.held_seats.pop(code, None)
+
+   @instrumented("expire_holds")
+   @shared_write
+   def expire_holds(self, now=None):
+       # Release every hold whose time ran out; returns their ids
+       now = time.monotonic() if now is None else now
+       with self.lock:
+           expired = self.hold_timers.advance(now)
+           promoted = []
+           for hold_id in expired:
+               name, code = self._pop_hold(hold_id)
+               promoted += self._promote_waitlist(code)
+           if promoted:
+               self.save_bookings()
+           return expired
+
+   def _expire_replayed_holds(self, now=None):
+       # A replica has no holds of its own: it only frees the seats of replayed holds that ran out,
+       # in memory. The writer that made them logs the release and gives the seat to the waitlist.
+       now = time.monotonic() if now is None else now
+       with self.lock:
+           for hold_id in self.hold_timers.advance(now):
+               self._pop_hold(hold_id)
+
+   @instrumented("join_waitlist")
+   @shared_write
+   def join_waitlist(self, name, code, priority=0):
+       # Wait for a seat on a flight; returns the place in line or None
+       with self.lock:
+           if not name or not self.get_flight(code) or self.bookings.get(name) == code:
+               return None
+           self._materialize(code)
+           waitlist = self.waitlists.setdefault(code, Waitlist())
+           if name not in waitlist:
+               request_time = time.time()
+               waitlist.add(name, priority, request_time, next(self.waitlist_sequence))
+               self.waitlisted += 1
+               self._log_waitlist({"op": "join", "code": code, "name": name, "priority": priority, "time": request_time})
+           return waitlist.position(name)
+
+   @instrumented("leave_waitlist")
+   @shared_write
+   def leave_waitlist(self, name, code):
+       with self.lock:
+           waitlist = self.waitlists.get(code)
+           if not waitlist or not waitlist.remove(name):
+               return False
+           self.waitlisted -= 1
+           self._log_waitlist({"op": "leave", "code": code, "name": name})
+           return True
+
+   @instrumented("waitlist_position")
+   def waitlist_position(self, name, code):
+       waitlist = self.waitlists.get(code)
+       return waitlist.position(name) if waitlist else None
+
+   def _promote_waitlist(self, code):
+       # Give free seats to the first people in line; the caller saves bookings
+       promoted = []
+       waitlist = self.waitlists.get(code)
+       while waitlist and self._free_seats(code) > 0:
+           name = waitlist.pop()
+           if name is None:
+               break
+           self.waitlisted -= 1
+           self._log_waitlist({"op": "leave", "code": code, "name": name})
+           if self.bookings.get(name) == code:
+               continue # Already on this flight
+           old_code = self.bookings.get(name)
+           self._set_booking(name, code)
+           promoted.append(name)
+           if old_code is not None:
+               promoted += self._promote_waitlist(old_code) # Their old seat opens up too
+       return promoted
+
+   @instrumented("view_booking")
    def view_booking(self, name):
+       self.sync() # Pick up bookings made by other processes (cheap when nothing changed)
+       flight = self.lookup_cache.get(name, _MISSING)
+       if flight is not _MISSING:
+           return flight # Repeated lookups are answered from the cache
+       version = self.data_version
        code = self.bookings.get(name) # Get the flight code
-       if code:
-           return self.get_flight(code) # Return the flight object
-       return None # If not booked
+       flight = self.get_flight(code) if code else None # None if not booked
+       if self.data_version == version: # A change in the meantime may already have invalidated this name
+           self.lookup_cache.put(name, flight)
+       return flight
 
+   @instrumented("cancel_booking")
+   @shared_write
    def cancel_booking(self, name):
-       if name in self.bookings:
-           del self.bookings[name] # Remove the booking
-           self.save_bookings() # Save changes
-           return True
-       return False # Nothing to cancel
+       with self._booking_change():
+           if name in self.bookings:
+               code = self._drop_booking(name) # Remove the booking
+               self._promote_waitlist(code) # Someone waiting gets the seat
+               self._save_booking_change() # Save changes
+               return True
+           return False # Nothing to cancel
+
+   @instrumented("add_flight")
+   @shared_write
+   def add_flight(self, code, destination, date_time):
+       # Create a flight, add it to the schedule and save it
+       with self.lock:
+           flight = Flight(code, destination, date_time)
+           self._insert_flight(flight)
+           self.save_flights()
+           return flight
+
+   def _insert_flight(self, flight):
+       self._record("add_flight", flight=flight.to_dict())
+       self.flights.append(flight)
+       self.flight_index.setdefault(flight.code, flight)
+       self._invalidate_flight(flight.code)
+       self.events.publish(FlightAdded(flight))
  
+   @instrumented("delete_flight")
+   @shared_write
    def delete_flight(self, code):
-       # Check if flight exists
-       flight = self.get_flight(code)
-       if not flight:
-           return False # Flight not found
-       # Check if any bookings exist for this flight
-       for name, booked_code in self.bookings.items():
-           if booked_code == code:
+       with self.lock:
+           self._materialize(code) # Deleting one scheduled departure skips that day of the rule
+           # Check if flight exists
+           flight = self.get_flight(code)
+           if not flight:
+               return False # Flight not found
+           # Check if any bookings exist for this flight
+           if self.booked_count(code):
                return False # Can't delete, flight is booked
-       # Remove the flight
+           # Remove the flight
+           self._remove_flight(code)
+           self.save_flights()
+           self._drop_waitlist(code)
+           return True
+
+   def _remove_flight(self, code):
+       self._record("delete_flight", code=code)
        self.flights = [f for f in self.flights if f.code != code]
+       del self.flight_index[code]
+       self._invalidate_flight(code)
+       route, _, day = code.rpartition("-")
+       if route in self.schedules and len(day) == 8 and day.isdigit():
+           self.schedules[route].exceptions.add(f"{day[:4]}-{day[4:6]}-{day[6:]}") # Don't offer the departure again
+           self.instance_cache.invalidate(code)
+           if not self.replaying:
+               self.save_schedules()
+       self.events.publish(FlightDeleted(code))
+
+   def _drop_waitlist(self, code):
+       # Nobody can wait for a removed flight
+       if code in self.waitlists:
+           for name in list(self.waitlists[code].entries):
+               self.leave_waitlist(name, code)
+           del self.waitlists[code]
+
+   def departures_to(self, destination):
+       # Flights to a destination (None = everywhere) sorted by departure time (unreadable times go last)
+       if self.departure_index is None:
+           self.departure_index = {None: []}
+           for code, flight in self.flight_index.items():
+               departure = parse_departure(flight.date_time) or datetime.max
+               self.departure_index.setdefault(flight.destination, []).append((departure, code))
+               self.departure_index[None].append((departure, code))
+           for departures in self.departure_index.values():
+               departures.sort()
+       return self.departure_index.get(destination, [])
+
+   @instrumented("cancel_flight")
+   @shared_write
+   def cancel_flight(self, code):
+       # Cancel a flight even if it has passengers and move them to later flights to the same place.
+       # Returns {"rebooked": {name: new_code}, "waitlisted": [...], "dropped": [...]} or None.
+       with self.lock:
+           self._materialize(code)
+           flight = self.get_flight(code)
+           if not flight:
+               return None
+           departure = parse_departure(flight.date_time) or datetime.min
+           departures = self.departures_to(flight.destination)
+           start = bisect.bisect_right(departures, (departure, code))
+           alternatives = [other for _, other in departures[start:] if other != code]
+           passengers = sorted(self.passengers_on(code))
+           result = {"rebooked": {}, "waitlisted": [], "dropped": []}
+           position = 0
+           for other in alternatives: # Fill the next flights in departure order
+               free = self._free_seats(other)
+               for name in passengers[position:position + max(free, 0)]:
+                   self._set_booking(name, other)
+                   result["rebooked"][name] = other
+               position += max(free, 0)
+               if position >= len(passengers):
+                   break
+           for name in passengers[position:]:
+               self._drop_booking(name)
+               result["dropped" if not alternatives else "waitlisted"].append(name)
+           # Nobody waits for the cancelled flight any more; disrupted passengers go first on the next one
+           waiting = self.waitlists[code].entries if code in self.waitlists else {}
+           changes = [{"op": "leave", "code": code, "name": name} for name in waiting]
+           request_time = time.time()
+           for name in result["waitlisted"]:
+               if name not in self.waitlists.get(alternatives[0], ()):
+                   changes.append({"op": "join", "code": alternatives[0], "name": name, "priority": 1, "time": request_time})
+           for change in changes:
+               self._apply_waitlist_change(change)
+           # Remove the flight and save everything in one go
+           self._remove_flight(code)
+           self.save_transaction(changes)
+           return result
+
+   @instrumented("reschedule_flight")
+   @shared_write
+   def reschedule_flight(self, code, date_time):
+       # Move a flight to a new time; its passengers keep their seats
+       with self.lock:
+           self._materialize(code)
+           flight = self.get_flight(code)
+           if not flight or not date_time:
+               return None
+           self._retime_flight(flight, date_time)
+           self.save_flights()
+           return flight
+
+   def _retime_flight(self, flight, date_time):
+       self._record("reschedule", code=flight.code, date_time=date_time)
+       flight.date_time = date_time
+       self._invalidate_flight(flight.code)
+       self.events.publish(FlightChanged(flight))
+
+   @instrumented("save_transaction")
+   def save_transaction(self, waitlist_changes=()):
+       # Write flights, bookings and waitlist changes together: a journal goes first so a crash half way
+       # through can be finished by recover_transaction the next time the system starts
+       self.storage.write_json("transaction.json", {"flights": [flight.to_dict() for flight in self.flights], "bookings": dict(self.bookings),
+                                                    "waitlist": list(waitlist_changes)}, atomic=True)
+       self.save_flights()
+       self.save_bookings()
+       for change in waitlist_changes:
+           self._log_waitlist(change) # Already applied in memory; a repeated change is harmless on replay
+       self.storage.remove("transaction.json")
+
+   @instrumented("recover_transaction")
+   def recover_transaction(self):
+       if not self.storage.exists("transaction.json"):
+           return False
+       journal = self.storage.read_json("transaction.json")
+       self.flights = [flight_from_dict(data) for data in journal["flights"]]
+       self.rebuild_flight_index()
+       for name in [name for name in self.bookings if name not in journal["bookings"]]:
+           self._drop_booking(name)
+       for name, code in journal["bookings"].items():
+           if self.bookings.get(name) != code:
+               self._set_booking(name, code)
+       changes = journal.get("waitlist", [])
+       for change in changes:
+           self._apply_waitlist_change(change)
+       if self.read_only:
+           return True # Memory matches the journal now; the next writer finishes the files
        self.save_flights()
+       self.save_bookings()
+       for change in changes:
+           self._log_waitlist(change)
+       self.storage.remove("transaction.json")
        return True
+
+   def _flight_fragment(self, code):
+       # Formatted flight text used by the reports, built once per flight
+       text = self.fragment_cache.get(code)
+       if text is None:
+           flight = self.get_flight(code)
+           if flight is None:
+               return None
+           text = str(flight)
+           self.fragment_cache.put(code, text)
+       return text
+
+   def _index_name(self, event):
+       if self.name_index_stale:
+           return # Rebuilt on the next search
+       if isinstance(event, BookingCreated):
+           self.name_index.add(event.name)
+       elif event.name not in self.bookings: # A move to another flight keeps the name
+           self.name_index.remove(event.name)
+
+   @instrumented("find_passengers")
+   def find_passengers(self, query, limit=5):
+       # Booked passenger names closest to a possibly mistyped name, best match first
+       self.sync()
+       if not query:
+           return []
+       with self.lock: # A following replica may be applying changes on another thread
+           if self.name_index_stale:
+               self.name_index.clear()
+               for name in self.bookings:
+                   self.name_index.add(name)
+               self.name_index_stale = False
+           return self.name_index.search(query, limit)
+
+   @instrumented("quote_fare")
+   def quote_fare(self, code, fare_class="economy", now=None):
+       # Current price of one seat, None if the flight or fare class doesn't exist
+       flight = self.get_flight(code)
+       if flight is None or fare_class not in FareEngine.FARE_CLASSES:
+           return None
+       return self.fares.quote(flight, fare_class, now)
+
+   @instrumented("quote_fares")
+   def quote_fares(self, codes, fare_class="economy", now=None):
+       # Prices for a whole page of search results: code -> fare
+       now = now or datetime.now()
+       return {code: self.quote_fare(code, fare_class, now) for code in codes}
+
+   @instrumented("archive_departed")
+   @shared_write
+   def archive_departed(self, now=None, directory=None):
+       # Move flights that already left (and their bookings) into gzip segments, one per month.
+       # Each call appends a new gzip member, so old segments are never rewritten.
+       now = now or datetime.now()
+       directory = directory or self.storage.path("archive")
+       with self.lock:
+           departed = []
+           for flight in self.flights:
+               departure = parse_departure(flight.date_time)
+               if departure is not None and departure < now and flight.code not in departed:
+                   departed.append(flight.code)
+           if not departed:
+               return 0
+           os.makedirs(directory, exist_ok=True)
+           index = self._read_archive_index(directory)
+           segments = {} # "YYYY-MM" -> records to append
+           for code in departed:
+               flight = self.get_flight(code)
+               month = parse_departure(flight.date_time).strftime("%Y-%m")
+               records = segments.setdefault(month, [])
+               records.append(dict(flight.to_dict(), type="flight"))
+               for name in sorted(self.passengers_on(code)):
+                   records.append({"type": "booking", "name": name, "code": code})
+               index[code] = month
+           for month, records in segments.items():
+               with gzip.open(os.path.join(directory, f"{month}.jsonl.gz"), "at") as f:
+                   for record in records:
+                       f.write(json.dumps(record) + "\n")
+           write_json_atomic(os.path.join(directory, "index.json"), index)
+           # Now drop them from the working set and save it in one go
+           for code in departed:
+               for name in self.passengers_on(code):
+                   self._drop_booking(name)
+               self._remove_flight(code)
+           self.save_transaction()
+           for code in departed:
+               self._drop_waitlist(code)
+           return len(departed)
+
+   @instrumented("write_manifests")
+   def write_manifests(self, directory=None, within_hours=None, now=None, combined=False, workers=8):
+       # Passenger manifest (CSV) for every flight, or only those leaving in the next within_hours.
+       # One file per flight, or all of them in one zip; returns the paths written.
+       now = now or datetime.now()
+       directory = directory or self.output_path("manifests")
+       flights = self.query()
+       if within_hours is not None:
+           flights = flights.departing(after=now, before=now + timedelta(hours=within_hours)).order_by("departure")
+       with self.lock: # Copy the passenger lists, then write without holding up bookings
+           jobs = [(flight.to_dict(), sorted(self.passengers_on(flight.code))) for flight in flights]
+       os.makedirs(directory, exist_ok=True)
+       with ThreadPoolExecutor(max_workers=workers) as pool:
+           if combined:
+               path = os.path.join(directory, f"manifests-{now:%Y%m%d-%H%M}.zip")
+               with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive: # Only this thread writes the zip
+                   for (flight, _), text in zip(jobs, pool.map(manifest_text, jobs)):
+                       archive.writestr(f"{flight['code']}.csv", text)
+               return [path]
+           return list(pool.map(functools.partial(self._write_manifest_file, directory), jobs))
+
+   def _write_manifest_file(self, directory, job):
+       path = os.path.join(directory, f"{job[0]['code'].replace(os.sep, '_')}.csv")
+       with open(path, "w", newline="") as f:
+           write_manifest(f, *job)
+       return path
+
+   def _read_archive_index(self, directory):
+       # Flight code -> month of the segment holding it
+       path = os.path.join(directory, "index.json")
+       if not os.path.exists(path):
+           return {}
+       with open(path, "r") as f:
+           return json.load(f)
+
+   @instrumented("query_archive")
+   def query_archive(self, month=None, code=None, name=None, directory=None):
+       # Read archived flights/bookings on demand; month ("YYYY-MM") or code limit it to one segment
+       directory = directory or self.storage.path("archive")
+       if not os.path.isdir(directory):
+           return []
+       if code and not month:
+           month = self._read_archive_index(directory).get(code)
+           if month is None:
+               return []
+       if month:
+           files = [f"{month}.jsonl.gz"]
+       else:
+           files = sorted(f for f in os.listdir(directory) if f.endswith(".jsonl.gz"))
+       results = []
+       for file_name in files:
+           path = os.path.join(directory, file_name)
+           if not os.path.exists(path):
+               continue
+           with gzip.open(path, "rt") as f:
+               for line in f:
+                   record = json.loads(line)
+                   if code and record["code"] != code:
+                       continue
+                   if name and record.get("name") != name:
+                       continue
+                   results.append(record)
+       return results
+
+   @instrumented("reshard")
+   @shared_write
+   def reshard(self, shard_count):
+       # Change how many files the sharded booking store uses
+       if not self.shard_store:
+           return False
+       self.shard_store.rebalance(shard_count)
+       return True
+
+   def output_path(self, name):
+       # Where a file the app writes for people (traces, profiles, metrics) goes: next to the data files,
+       # or the working folder when the data is only in memory
+       try:
+           return self.storage.path(name)
+       except ValueError:
+           return name
+
+   def metrics_snapshot(self):
+       # Operation timings plus cache counters, ready to show or export
+       snapshot = self.metrics.snapshot()
+       snapshot["caches"] = self.cache_stats()
+       return snapshot
+
+   def cache_stats(self):
+       # Hit and miss counters for both caches
+       return {"lookups": self.lookup_cache.stats(), "fragments": self.fragment_cache.stats()}
   
+   @instrumented("get_all_bookings_report")
    def get_all_bookings_report(self):
+       self.sync()
        report = []
-       for name, code in self.bookings.items():
-           flight = self.get_flight(code)
-           if flight:
-               report.append(f"Passenger: {name}, Flight: {flight}")
+       fragments = {} # Flight id -> report text, so the join works on ids and names are only decoded for output
+       with self.lock: # A following replica may be applying changes on another thread
+           for passenger, flight in self.booking_ids():
+               if flight not in fragments:
+                   fragments[flight] = self._flight_fragment(self.flight_ids.decode(flight))
+               if fragments[flight]:
+                   report.append(f"Passenger: {self.passenger_ids.decode(passenger)}, Flight: {fragments[flight]}")
        return "\n".join(report) if report else "No bookings found."
   
+   @instrumented("get_flights_summary_report")
    def get_flights_summary_report(self):
+       flights = self.query() # No filters, so the planner scans every flight in order
        report = []
-       for flight in self.flights:
-           booking_count = sum(1 for name, code in self.bookings.items() if code == flight.code)
-           report.append(f"{flight} - Bookings: {booking_count}")
+       with self.lock:
+           for flight in flights:
+               booking_count = self.booked_count(flight.code)
+               fragment = self._flight_fragment(flight.code) if self.flight_index.get(flight.code) is flight else str(flight)
+               report.append(f"{fragment} - Bookings: {booking_count}")
        return "\n".join(report) if report else "No flights available."
 
 # Base frame class for common setup
@@ -119,6 +3041,8 @@ class BaseFrame(tk.Frame):
        parent.grid_rowconfigure(0, weight=1) # Vertical stretch
        parent.grid_columnconfigure(0, weight=1) # Horizontal stretch
 
+   shown_version = None # data_version of the system when this frame last drew its data
+
 # Login frame class
 class LoginFrame(BaseFrame):
    def __init__(self, parent, app):
@@ -252,6 +3176,8 @@ class BookingFrame(BaseFrame):
         )
         self.flight_listbox.pack(fill="x", padx=5, pady=5)
 
+        self.listed_flights = []  # Flight shown on each listbox row
+
         # Flight details display (ensured initialization)
         self.selected_flight_label = tk.Label(
             flight_frame, 
@@ -298,51 +3224,98 @@ class BookingFrame(BaseFrame):
             command=lambda: self.app.show_frame(self.app.main_frame)
         ).pack(side="right", padx=10)
 
+    @profiled_handler("update_flight_listbox")
     def update_flight_listbox(self):
         # Populate listbox with flights
+        self.shown_version = self.system.data_version
         self.flight_listbox.delete(0, tk.END)
-        if not self.system.flights:
+        self.listed_flights = self.system.bookable_flights()  # Flight shown on each row (with upcoming scheduled departures)
+        if not self.listed_flights:
             self.flight_listbox.insert(tk.END, "No flights available")
             self.selected_flight_label.config(text="No flights available")
             return
-        for flight in self.system.flights:
+        for flight in self.listed_flights:
             self.flight_listbox.insert(tk.END, f"{flight.code}: {flight.destination} at {flight.date_time}")
         self.flight_listbox.select_set(0)  # Select first flight by default
         self.update_flight_info()  # Update details for default selection
 
+    def apply_events(self, events):
+        # Change only the rows of flights that were added, moved or removed
+        for event in events:
+            if isinstance(event, DataReloaded) or not self.listed_flights:
+                self.update_flight_listbox()  # Start over (also replaces the "No flights" row)
+                return
+            if isinstance(event, FlightAdded):
+                codes = [flight.code for flight in self.listed_flights]
+                if event.flight.code in codes:  # A scheduled departure was booked and saved, same row
+                    self.listed_flights[codes.index(event.flight.code)] = event.flight
+                    continue
+                self.listed_flights.append(event.flight)
+                self.flight_listbox.insert(tk.END, f"{event.flight.code}: {event.flight.destination} at {event.flight.date_time}")
+            elif isinstance(event, FlightDeleted):
+                for index in reversed(range(len(self.listed_flights))):
+                    if self.listed_flights[index].code == event.code:
+                        del self.listed_flights[index]
+                        self.flight_listbox.delete(index)
+                if not self.listed_flights:
+                    self.update_flight_listbox()
+                    return
+            elif isinstance(event, FlightChanged):
+                for index, flight in enumerate(self.listed_flights):
+                    if flight is event.flight:
+                        self.flight_listbox.delete(index)
+                        self.flight_listbox.insert(index, f"{flight.code}: {flight.destination} at {flight.date_time}")
+        self.shown_version = self.system.data_version
+        self.update_flight_info()
+
+    def selected_flight(self):
+        # Flight on the selected row (IndexError if nothing is selected)
+        return self.listed_flights[self.flight_listbox.curselection()[0]]
+
     def update_flight_info(self, event=None):
         # Update flight details based on listbox selection
-        if not self.system.flights:
+        if not self.listed_flights:
             self.selected_flight_label.config(text="No flights available")
             return
         try:
-            index = self.flight_listbox.curselection()[0]
-            flight = self.system.flights[index]
-            self.selected_flight_label.config(text=f"Selected: {flight.destination} at {flight.date_time}")
+            flight = self.selected_flight()
+            fare = self.system.quote_fare(flight.code)
+            self.selected_flight_label.config(text=f"Selected: {flight.destination} at {flight.date_time} - ${fare:.2f}")
         except IndexError:
             self.selected_flight_label.config(text="No flight selected")
 
+    @profiled_handler("handle_booking")
     def handle_booking(self):
         name = self.app.current_user
-        if not self.system.flights:
+        if not self.listed_flights:
             messagebox.showerror("Error", "No flights available to book.")
             return
         try:
-            index = self.flight_listbox.curselection()[0]
-            flight = self.system.flights[index]
+            flight = self.selected_flight()
             code = flight.code
+            # Hold the seat while the clerk confirms so nobody else can take it
+            hold_id = self.system.hold_seat(name, code)
+            if hold_id is None:
+                if messagebox.askyesno("Flight Full", f"{flight} is full. Join the waitlist?"):
+                    position = self.system.join_waitlist(name, code)
+                    if position:
+                        messagebox.showinfo("Waitlisted", f"{name} is number {position} on the waitlist.")
+                    else:
+                        messagebox.showerror("Error", "Could not join the waitlist.")
+                return
             # Confirmation dialog
             confirm = messagebox.askyesno(
                 "Confirm Booking", 
                 f"Book {name} on {flight}?"
             )
             if confirm:
-                booked_flight = self.system.book_flight(name, code)
+                booked_flight = self.system.confirm_hold(hold_id)
                 if booked_flight:
                     messagebox.showinfo("Success", f"{name} booked on {booked_flight}")
-                    self.app.reports_frame.refresh_report()  # Update reports
                 else:
-                    messagebox.showerror("Error", "Booking failed.")
+                    messagebox.showerror("Error", "Booking failed. The seat hold may have expired.")
+            else:
+                self.system.release_hold(hold_id)  # Give the seat back
         except IndexError:
             messagebox.showerror("Error", "Please select a flight.")
 
@@ -350,9 +3323,18 @@ class BookingFrame(BaseFrame):
         # Update flight listbox (renamed for consistency)
         self.update_flight_listbox()
 
+    def refresh(self):
+        # Called by FlightApp.show_frame when flights changed since the last draw
+        self.update_flight_listbox()
+
     def update_user_label(self):
         self.user_var.set(f"Booking for: {self.app.current_user}")
 
+# "Did you mean" line for a name with no booking (empty if nothing is close)
+def suggestion_text(system, name):
+   matches = [match for match in system.find_passengers(name, limit=3) if match != name]
+   return f"\nDid you mean: {', '.join(matches)}?" if matches else ""
+
 # View booking frame class
 class ViewFrame(BaseFrame):
    def __init__(self, parent, app, system):
@@ -368,13 +3350,14 @@ class ViewFrame(BaseFrame):
        tk.Button(self, text="View", command=self.handle_view).pack(pady=5)
        tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.main_frame)).pack()
 
+   @profiled_handler("handle_view")
    def handle_view(self):
        name = self.app.current_user # Use logged-in user’s name
        flight = self.system.view_booking(name)
        if flight:
            messagebox.showinfo("Booking Found", f"{name} is booked on {flight}")
        else:
-           messagebox.showerror("Not Found", "No booking found.")
+           messagebox.showerror("Not Found", "No booking found." + suggestion_text(self.system, name))
 
    def update_user_label(self):
        self.user_var.set(f"Viewing for: {self.app.current_user}") # Update the user label
@@ -394,13 +3377,13 @@ class CancelFrame(BaseFrame):
        tk.Button(self, text="Cancel Booking", command=self.handle_cancel).pack(pady=5)
        tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.main_frame)).pack()
 
+   @profiled_handler("handle_cancel")
    def handle_cancel(self):
        name = self.app.current_user # Use logged-in user’s name
        if self.system.cancel_booking(name):
            messagebox.showinfo("Cancelled", f"Booking for {name} has been cancelled.")
-           self.app.reports_frame.refresh_report() # Refresh reports after cancellation
        else:
-           messagebox.showerror("Error", "No booking found to cancel.")
+           messagebox.showerror("Error", "No booking found to cancel." + suggestion_text(self.system, name))
 
    def update_user_label(self):
        self.user_var.set(f"Canceling for: {self.app.current_user}") # Update the user label
@@ -415,8 +3398,13 @@ class AdminFrame(BaseFrame):
        tk.Label(self, text="Welcome, Admin", font=("Arial", 12)).pack(pady=10) # Welcome message
        tk.Button(self, text="Manage Flights", command=lambda: self.app.show_frame(self.app.manage_flights_frame)).pack(pady=10)
        tk.Button(self, text="View Reports", command=lambda: self.app.show_frame(self.app.reports_frame)).pack(pady=10)
+       tk.Button(self, text="Performance", command=self.open_performance).pack(pady=10)
        tk.Button(self, text="Logout", command=lambda: self.app.show_frame(self.app.login_frame)).pack(pady=10)
 
+   def open_performance(self):
+       self.app.show_frame(self.app.performance_frame)
+       self.app.performance_frame.show_metrics() # Show the latest numbers
+
 # Manage flights frame class
 class ManageFlightsFrame(BaseFrame):
    def __init__(self, parent, app, system):
@@ -435,23 +3423,80 @@ class ManageFlightsFrame(BaseFrame):
        self.delete_code_entry.pack()
 
        tk.Button(self, text="Delete Flight", command=self.handle_delete_flight).pack(pady=5)
+       tk.Button(self, text="Cancel Flight & Rebook", command=self.handle_cancel_flight).pack(pady=5)
+       tk.Label(self, text="New Date & Time (YYYY-MM-DD HH:MM):").pack()
+       self.new_time_entry = tk.Entry(self)
+       self.new_time_entry.pack()
+       tk.Button(self, text="Reschedule Flight", command=self.handle_reschedule_flight).pack(pady=5)
        tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.admin_frame)).pack(pady=10)
 
+   @profiled_handler("display_flights")
    def display_flights(self):
+       self.shown_version = self.system.data_version
        self.flights_text.delete("1.0", tk.END) # Clear previous text
-       for flight in self.system.flights: # Loop through all flight objects
+       self.listed_flights = self.system.query().all() # Flight on each line of the text box
+       for flight in self.listed_flights: # Loop through all flight objects
            self.flights_text.insert(tk.END, f"{flight}\n") # Add each to the text box
 
+   def apply_events(self, events):
+       # Edit only the lines of flights that changed
+       for event in events:
+           if isinstance(event, DataReloaded):
+               self.display_flights()
+               return
+           if isinstance(event, FlightAdded):
+               self.listed_flights.append(event.flight)
+               self.flights_text.insert(tk.END, f"{event.flight}\n")
+           elif isinstance(event, FlightDeleted):
+               for index in reversed(range(len(self.listed_flights))):
+                   if self.listed_flights[index].code == event.code:
+                       del self.listed_flights[index]
+                       self.flights_text.delete(f"{index + 1}.0", f"{index + 2}.0") # Text lines start at 1
+           elif isinstance(event, FlightChanged):
+               for index, flight in enumerate(self.listed_flights):
+                   if flight is event.flight:
+                       self.flights_text.delete(f"{index + 1}.0", f"{index + 2}.0")
+                       self.flights_text.insert(f"{index + 1}.0", f"{flight}\n")
+       self.shown_version = self.system.data_version
+
+   def refresh(self):
+       self.display_flights() # Flights changed while this page was hidden
+
+   @profiled_handler("handle_delete_flight")
    def handle_delete_flight(self):
        code = self.delete_code_entry.get().strip()
        if self.system.delete_flight(code):
            messagebox.showinfo("Success", f"Flight {code} deleted.")
-           self.display_flights() # Refresh the flight list
            self.delete_code_entry.delete(0, tk.END)
-           self.app.booking_frame.refresh_flight_menu() # Update booking dropdown
        else:
            messagebox.showerror("Error", "Flight not found or has bookings.")
 
+   @profiled_handler("handle_cancel_flight")
+   def handle_cancel_flight(self):
+       code = self.delete_code_entry.get().strip()
+       if not messagebox.askyesno("Confirm", f"Cancel flight {code} and move its passengers?"):
+           return
+       result = self.system.cancel_flight(code)
+       if result is None:
+           messagebox.showerror("Error", "Flight not found.")
+           return
+       messagebox.showinfo("Flight Cancelled",
+                           f"Rebooked: {len(result['rebooked'])}\nWaitlisted: {len(result['waitlisted'])}\nNo alternative: {len(result['dropped'])}")
+       self.delete_code_entry.delete(0, tk.END)
+
+   @profiled_handler("handle_reschedule_flight")
+   def handle_reschedule_flight(self):
+       code = self.delete_code_entry.get().strip()
+       date_time = self.new_time_entry.get().strip()
+       if parse_departure(date_time) is None:
+           messagebox.showerror("Error", "Please enter the new time as YYYY-MM-DD HH:MM.")
+           return
+       if self.system.reschedule_flight(code, date_time):
+           messagebox.showinfo("Success", f"Flight {code} moved to {date_time}.")
+           self.new_time_entry.delete(0, tk.END)
+       else:
+           messagebox.showerror("Error", "Flight not found.")
+
 # Add flight frame class
 class AddFlightFrame(BaseFrame):
    def __init__(self, parent, app, system):
@@ -472,32 +3517,42 @@ class AddFlightFrame(BaseFrame):
        self.new_datetime_entry = tk.Entry(self)
        self.new_datetime_entry.pack()
 
+       tk.Label(self, text="Repeat daily until (YYYY-MM-DD, optional):").pack()
+       self.repeat_until_entry = tk.Entry(self)
+       self.repeat_until_entry.pack()
+
        tk.Button(self, text="Submit", command=self.add_new_flight).pack(pady=10)
        tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.manage_flights_frame)).pack()
 
+   @profiled_handler("add_new_flight")
    def add_new_flight(self):
        # Get user input from the entry boxes
        code = self.new_code_entry.get()
        destination = self.new_destination_entry.get()
        date_time = self.new_datetime_entry.get()
+       repeat_until = self.repeat_until_entry.get().strip()
 
        # Basic validation: make sure none are empty
        if not code or not destination or not date_time:
            messagebox.showerror("Error", "Please fill in all fields.")
            return
 
-       # Create a new Flight object with entered info
-       new_flight = Flight(code, destination, date_time)
-       self.system.flights.append(new_flight)
-       self.system.save_flights() # Save to file
-
-       messagebox.showinfo("Success", f"Flight {code} added successfully!")
+       if repeat_until:
+           # One rule instead of a flight per day; departures are saved when booked
+           start, _, time_of_day = date_time.partition(" ")
+           if not self.system.add_schedule(code, destination, time_of_day, start, repeat_until):
+               messagebox.showerror("Error", "Could not add the schedule. Check the dates and that the code is new.")
+               return
+           messagebox.showinfo("Success", f"Flight {code} added daily until {repeat_until}!")
+       else:
+           # Create a new Flight object with entered info
+           self.system.add_flight(code, destination, date_time) # Also saves to file
+           messagebox.showinfo("Success", f"Flight {code} added successfully!")
        self.new_code_entry.delete(0, tk.END)
        self.new_destination_entry.delete(0, tk.END)
        self.new_datetime_entry.delete(0, tk.END)
+       self.repeat_until_entry.delete(0, tk.END)
 
-       self.app.manage_flights_frame.display_flights() # Refresh flight list
-       self.app.booking_frame.refresh_flight_menu() # Update booking dropdown
        self.app.show_frame(self.app.manage_flights_frame) # Go back
 
 # Reports frame class
@@ -516,56 +3571,265 @@ class ReportsFrame(BaseFrame):
        tk.Button(self, text="Flights Summary Report", command=self.show_flights_summary).pack(pady=5) # Button for flights report
        tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.admin_frame)).pack(pady=10) # Back to admin menu
 
+   @profiled_handler("show_all_bookings")
    def show_all_bookings(self):
        self.current_report = "bookings" # Set current report type
        self.report_text.delete("1.0", tk.END) # Clear text box
        report = self.system.get_all_bookings_report() # Get bookings report
        self.report_text.insert(tk.END, report) # Display report
 
+   @profiled_handler("show_flights_summary")
    def show_flights_summary(self):
        self.current_report = "flights" # Set current report type
        self.report_text.delete("1.0", tk.END) # Clear text box
        report = self.system.get_flights_summary_report() # Get flights report
        self.report_text.insert(tk.END, report) # Display report
 
+   def refresh(self):
+       self.refresh_report() # Bookings or flights changed while this page was hidden
+
+   def apply_events(self, events):
+       # One redraw per batch, and only while the page is on screen (show_frame catches up later)
+       if self.app.current_frame is self:
+           self.refresh_report()
+
    def refresh_report(self):
        # Refresh the current report if one is displayed
+       self.shown_version = self.system.data_version
        if self.current_report == "bookings":
            self.show_all_bookings()
        elif self.current_report == "flights":
            self.show_flights_summary()
 
+# Performance frame class: timings of the reservation system for admins
+class PerformanceFrame(BaseFrame):
+   def __init__(self, parent, app, system):
+       super().__init__(parent)
+       self.app = app # Reference to FlightApp
+       self.system = system # Reference to ReservationSystem
+
+       tk.Label(self, text="Performance", font=("Arial", 16)).pack(pady=10)
+       self.status_var = tk.StringVar()
+       tk.Label(self, textvariable=self.status_var).pack() # Shows if metrics are on
+       self.metrics_text = tk.Text(self, width=50, height=15) # Text box for the timings
+       self.metrics_text.pack(pady=5)
+
+       tk.Button(self, text="Turn Metrics On/Off", command=self.toggle_metrics).pack(pady=5)
+       tk.Button(self, text="Refresh", command=self.show_metrics).pack(pady=5)
+       tk.Button(self, text="Export", command=self.export_metrics).pack(pady=5)
+       tk.Button(self, text="Back", command=lambda: self.app.show_frame(self.app.admin_frame)).pack(pady=10)
+
+   @profiled_handler("show_metrics")
+   def show_metrics(self):
+       metrics = self.system.metrics
+       self.status_var.set("Metrics are ON" if metrics.enabled else "Metrics are OFF")
+       self.metrics_text.delete("1.0", tk.END) # Clear text box
+       snapshot = self.system.metrics_snapshot()
+       self.metrics_text.insert(tk.END, f"{'Operation':<22}{'Calls':>7}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}\n")
+       for name, stats in snapshot["latency_seconds"].items():
+           self.metrics_text.insert(tk.END, f"{name:<22}{stats['count']:>7}{stats['p50'] * 1000:>8.2f}"
+                                            f"{stats['p99'] * 1000:>8.2f}{stats['max'] * 1000:>8.2f}\n")
+       for name, value in snapshot["counters"].items():
+           self.metrics_text.insert(tk.END, f"{name}: {value}\n")
+       for name, stats in snapshot["caches"].items():
+           self.metrics_text.insert(tk.END, f"{name} cache: {stats['hits']} hits, {stats['misses']} misses\n")
+
+   def toggle_metrics(self):
+       self.system.metrics.enabled = not self.system.metrics.enabled
+       self.show_metrics()
+
+   def export_metrics(self):
+       prom_path, json_path = self.system.output_path("metrics.prom"), self.system.output_path("metrics.json")
+       self.system.metrics.export(prom_path) # Prometheus text format
+       self.system.metrics.export(json_path, fmt="json")
+       messagebox.showinfo("Exported", f"Metrics saved to {prom_path} and {json_path}.")
+
 # Main application class
 class FlightApp:
-   def __init__(self):
-       self.system = ReservationSystem() # Create system object
+   def __init__(self, profile=False, slow_ms=200, trace=None, data_dir="."):
+       self.system = ReservationSystem(instrument=profile, shared=True, auto_archive=True, snapshot_interval=SNAPSHOT_INTERVAL,
+                                       trace=trace, data_dir=data_dir) # Create system object (other counters may share the files)
        self.current_user = "" # Initialize current user
+       self.profiler = (Profiler(slow_ms, self.system.output_path("profiles"), self.system.output_path("slow_events.log"))
+                        if profile else None) # Only set in profiling mode, writing next to the data files
        self.window = tk.Tk() # Create main window
+       if self.system.integrity_problems: # Found by the startup check
+           problems = self.system.integrity_problems
+           messagebox.showwarning("Data problems", "\n".join(describe_problem(problem) for problem in problems[:10])
+                                  + (f"\n... and {len(problems) - 10} more" if len(problems) > 10 else ""))
        self.window.title("Shabo Airline") # Window title
        self.window.geometry("400x500") # Size of the window
 
-       # Instantiate all frames
-       self.login_frame = LoginFrame(self.window, self)
-       self.main_frame = MainFrame(self.window, self)
-       self.booking_frame = BookingFrame(self.window, self, self.system)
-       self.view_frame = ViewFrame(self.window, self, self.system)
-       self.cancel_frame = CancelFrame(self.window, self, self.system)
-       self.admin_frame = AdminFrame(self.window, self)
-       self.manage_flights_frame = ManageFlightsFrame(self.window, self, self.system)
-       self.add_flight_frame = AddFlightFrame(self.window, self, self.system)
-       self.reports_frame = ReportsFrame(self.window, self, self.system)
+       # Frames are built the first time they are shown (see FRAME_TYPES and get_frame)
+       self.frames = {} # Attribute name -> frame that was built already
+       self.current_frame = None # Frame on top right now
+       self.pending_events = [] # (data_version, event) waiting for the next idle moment
+       self.system.events.subscribe(None, self.queue_event)
 
        self.show_frame(self.login_frame) # Show login page first
+       self.window.after(1000, self.poll_shared_store) # Watch for changes from other counters
+       if self.profiler:
+           self.profiler.watch_event_loop(self.window) # Warn when a callback blocks the window
+
+   # Attribute name -> (frame class, whether it needs the ReservationSystem)
+   FRAME_TYPES = {
+       "login_frame": (LoginFrame, False),
+       "main_frame": (MainFrame, False),
+       "booking_frame": (BookingFrame, True),
+       "view_frame": (ViewFrame, True),
+       "cancel_frame": (CancelFrame, True),
+       "admin_frame": (AdminFrame, False),
+       "manage_flights_frame": (ManageFlightsFrame, True),
+       "add_flight_frame": (AddFlightFrame, True),
+       "reports_frame": (ReportsFrame, True),
+       "performance_frame": (PerformanceFrame, True),
+   }
+
+   def __getattr__(self, name):
+       # Only called for missing attributes, so a frame is built on first use (e.g. self.app.booking_frame)
+       if name not in FlightApp.FRAME_TYPES:
+           raise AttributeError(name)
+       return self.get_frame(name)
+
+   def get_frame(self, name):
+       frame = self.frames.get(name)
+       if frame is None:
+           frame_type, needs_system = FlightApp.FRAME_TYPES[name]
+           frame = frame_type(self.window, self, self.system) if needs_system else frame_type(self.window, self)
+           frame.shown_version = self.system.data_version # The constructor drew the current data
+           self.frames[name] = frame
+           setattr(self, name, frame) # Later lookups skip __getattr__
+       return frame
+
+   def poll_shared_store(self):
+       self.system.sync() # Changes from other processes come back as events, so the views update
+       self.system.check_flights_file() # A new schedule dropped into flights.json
+       self.window.after(1000, self.poll_shared_store)
+
+   def queue_event(self, event):
+       # Collect events and handle them all in one go when Tk is idle
+       if not self.pending_events:
+           self.window.after_idle(self.flush_events)
+       self.pending_events.append((self.system.data_version, event))
+
+   def flush_events(self):
+       batch, self.pending_events = self.pending_events, []
+       for frame in list(self.frames.values()):
+           if not hasattr(frame, "apply_events"):
+               continue
+           # Skip events the frame already shows because it was redrawn after they happened
+           fresh = [event for version, event in batch if frame.shown_version is None or version > frame.shown_version]
+           if fresh:
+               frame.apply_events(fresh)
 
    def show_frame(self, frame):
+       self.current_frame = frame
        frame.tkraise() # Brings the chosen frame to the front
        if hasattr(frame, 'update_user_label'):
            frame.update_user_label() # Refresh frame if needed
+       if hasattr(frame, 'refresh') and frame.shown_version != self.system.data_version:
+           frame.refresh() # Data changed since this frame was last drawn
 
    def run(self):
-       self.window.mainloop() # Run the app
+       try:
+           self.window.mainloop() # Run the app
+       finally:
+           if self.profiler:
+               self.profiler.dump() # Save the handler profiles when the window closes
+               self.system.metrics.export(os.path.join(self.profiler.directory, "metrics.prom"))
+
+# Profile a scripted mix of operations without the GUI, on a copy of the data files
+def run_headless_profile(iterations=1000, slow_ms=200, data_dir="."):
+   profiler = Profiler(slow_ms, os.path.join(data_dir, "profiles"), os.path.join(data_dir, "slow_events.log")) # Results go next to the real data
+   scratch = tempfile.mkdtemp(prefix="ars_profile_")
+   for name in ("flights.json", "bookings.json"):
+       if os.path.exists(os.path.join(data_dir, name)):
+           shutil.copy(os.path.join(data_dir, name), scratch)
+   try:
+       system = profiler.run("startup", ReservationSystem, instrument=True, data_dir=scratch) # Never touch the real data files
+       codes = [flight.code for flight in system.flights] or ["NONE"]
+
+       def workload():
+           for i in range(iterations):
+               name = f"Profile Passenger {i % 200}"
+               system.book_flight(name, codes[i % len(codes)])
+               system.view_booking(name)
+               if i % 3 == 0:
+                   system.cancel_booking(name)
+               if i % 50 == 0:
+                   system.get_all_bookings_report()
+                   system.get_flights_summary_report()
+
+       profiler.run("workload", workload)
+       profiler.dump()
+       system.metrics.export(os.path.join(profiler.directory, "metrics.prom"))
+       return profiler
+   finally:
+       shutil.rmtree(scratch, ignore_errors=True)
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Shabo Airline reservation system")
+   parser.add_argument("--data-dir", default=".", metavar="DIR", help="folder holding the data files (default: current folder)")
+   parser.add_argument("--profile", action="store_true", help="profile GUI handlers and log slow events")
+   parser.add_argument("--slow-ms", type=float, default=200, help="threshold for slow handler / blocked event loop warnings")
+   parser.add_argument("--headless", type=int, metavar="N", help="profile N scripted operations without the GUI")
+   parser.add_argument("--list-snapshots", action="store_true", help="list the saved snapshots")
+   parser.add_argument("--restore", metavar="TIME", help='restore the data as of "YYYY-MM-DD HH:MM[:SS]" or a Unix time')
+   parser.add_argument("--report", choices=["bookings", "flights"], help="print a report from a read-only replica")
+   parser.add_argument("--follow", type=float, metavar="SECONDS", help="with --report, print it again when the data changes")
+   parser.add_argument("--check", action="store_true", help="check the data for orphan bookings, duplicate flights and other problems")
+   parser.add_argument("--full", action="store_true", help="with --check, verify every segment, not only the changed ones")
+   parser.add_argument("--manifests", metavar="DIR", help="write a passenger manifest per flight into DIR")
+   parser.add_argument("--within", type=float, metavar="HOURS", help="with --manifests, only flights leaving in the next HOURS")
+   parser.add_argument("--zip", action="store_true", help="with --manifests, write one zip instead of a file per flight")
+   parser.add_argument("--trace", nargs="?", const=True, metavar="PATH",
+                       help=f"record every operation to a JSONL trace (default {TRACE_FILE} in the data folder) for load_test.py --replay")
+   args = parser.parse_args(argv)
+   if args.list_snapshots:
+       for ts, path in SnapshotManager(os.path.join(args.data_dir, "snapshots")).list():
+           print(f"{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S}  {path}")
+       return
+   if args.restore:
+       timestamp = parse_timestamp(args.restore)
+       if timestamp is None:
+           parser.error(f"can't read the time {args.restore!r}")
+       system = ReservationSystem(snapshot_interval=SNAPSHOT_INTERVAL, data_dir=args.data_dir)
+       if system.restore_to(timestamp):
+           print(f"Restored to {datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S}: "
+                 f"{len(system.flights)} flights, {len(system.bookings)} bookings")
+       else:
+           print("No snapshot that early, nothing restored.")
+       return
+   if args.check:
+       system = ReservationSystem(shared=True, data_dir=args.data_dir, check_integrity=False)
+       problems = system.check_integrity(full=args.full)
+       for problem in problems:
+           print(describe_problem(problem))
+       print(f"{len(problems)} problem(s), {system.integrity.segments_checked} of {system.integrity.segments} segments verified")
+       raise SystemExit(1 if problems else 0)
+   if args.manifests:
+       paths = ReservationSystem(replica=True, data_dir=args.data_dir).write_manifests(args.manifests, args.within, combined=args.zip)
+       print(f"Wrote {len(paths)} file(s) to {args.manifests}")
+       return
+   if args.report:
+       # Reports from a replica never take the write lock, so counters keep booking at full speed
+       system = ReservationSystem(replica=True, data_dir=args.data_dir)
+       report = system.get_all_bookings_report if args.report == "bookings" else system.get_flights_summary_report
+       print(report())
+       try:
+           while args.follow:
+               time.sleep(args.follow)
+               if system.sync():
+                   print(f"\n--- {datetime.now():%H:%M:%S} ---\n{report()}")
+       except KeyboardInterrupt:
+           pass
+       return
+   if args.headless:
+       print(run_headless_profile(args.headless, args.slow_ms, args.data_dir).report())
+       return
+   app = FlightApp(profile=args.profile, slow_ms=args.slow_ms, trace=args.trace, data_dir=args.data_dir)
+   app.run()
 
 # Start the application
 if __name__ == "__main__":
-   app = FlightApp()
-   app.run()
\ No newline at end of file
+   main()
@@ -0,0 +1,278 @@
+# Load / soak test for the reservation system.
+# Runs many simulated counters (threads) against ReservationSystem without the GUI, in a
+# throw-away data folder, and prints throughput, p50/p99 latency and data file growth.
+# It can also replay a trace recorded with "AirlineCode.py --trace" as a repeatable workload.
+#
+# Example: python load_test.py --duration 600 --workers 8 --rate 500 --mix book=50,view=30,cancel=15,add_flight=3,delete_flight=2
+#          python load_test.py --replay request_trace.jsonl --data saved_data --fast
+import argparse # Command line options
+import json # Writing the final summary
+import os # Data folder and file sizes
+import random # Picking operations and passengers
+import shutil # Removing the data folder afterwards
+import tempfile # Isolated data folder
+import threading # One thread per simulated counter
+import time # Timing and pacing
+from AirlineCode import ReservationSystem, LatencyHistogram, FileStorage, MemoryStorage, trace_outcome
+
+DEFAULT_MIX = "book=50,view=30,cancel=15,add_flight=3,delete_flight=2"
+
+# Read "book=50,view=30,..." into a list of (operation, weight)
+def parse_mix(text):
+   mix = []
+   for part in text.split(","):
+      name, _, weight = part.partition("=")
+      if name.strip() not in LoadTest.OPERATIONS:
+         raise ValueError(f"unknown operation {name!r}")
+      mix.append((name.strip(), float(weight or 1)))
+   return mix
+
+# Total size in bytes of every data file
+def data_size(storage):
+   if isinstance(storage, MemoryStorage):
+      return sum(len(text) for text in storage.files.values())
+   total = 0
+   for root, _, files in os.walk(storage.directory):
+      for file_name in files:
+         total += os.path.getsize(os.path.join(root, file_name))
+   return total
+
+class LoadTest:
+   OPERATIONS = ("book", "view", "cancel", "add_flight", "delete_flight")
+
+   def __init__(self, mix, workers=4, rate=0, passengers=5000, flights=50, seed=None, system_options=None):
+      self.mix = mix # List of (operation, weight)
+      self.workers = workers # Simulated counters running at the same time
+      self.rate = rate # Total operations per second (0 = as fast as possible)
+      self.passengers = passengers # Size of the passenger name pool
+      self.flights = flights # Flights in the schedule at the start
+      self.random = random.Random(seed)
+      self.system_options = system_options or {} # Extra ReservationSystem options (shared, booking_shards, ...)
+      self.histograms = {name: LatencyHistogram() for name in self.OPERATIONS}
+      self.failures = {name: 0 for name in self.OPERATIONS} # Calls that returned False/None
+      self.errors = [] # Exceptions raised by the system
+      self.stats_lock = threading.Lock()
+      self.added_codes = [] # Flights created during the run (candidates for delete_flight)
+      self.next_flight = 0
+      self.system = None
+
+   def seed_schedule(self, storage):
+      # Future flights so nothing gets archived and every booking has somewhere to go
+      flights = [{"code": f"LT{i:04d}", "destination": f"City {i % 10}", "date_time": f"2099-{i % 12 + 1:02d}-{i % 28 + 1:02d} 10:00",
+                  "capacity": 10000} for i in range(self.flights)]
+      storage.write_json("flights.json", flights)
+
+   def run_operation(self, operation, rng):
+      system = self.system
+      if operation == "book":
+         code = system.flights[rng.randrange(len(system.flights))].code if system.flights else "NONE"
+         return system.book_flight(f"Passenger {rng.randrange(self.passengers)}", code)
+      if operation == "view":
+         return system.view_booking(f"Passenger {rng.randrange(self.passengers)}")
+      if operation == "cancel":
+         return system.cancel_booking(f"Passenger {rng.randrange(self.passengers)}")
+      if operation == "add_flight":
+         with self.stats_lock:
+            self.next_flight += 1
+            code = f"LD{self.next_flight:06d}"
+            self.added_codes.append(code)
+         return system.add_flight(code, f"City {self.next_flight % 10}", "2099-12-31 23:00")
+      with self.stats_lock:
+         if not self.added_codes:
+            return None
+         code = self.added_codes.pop(rng.randrange(len(self.added_codes)))
+      return system.delete_flight(code)
+
+   def worker(self, index, stop_at):
+      rng = random.Random(self.random.random() + index)
+      operations = [name for name, _ in self.mix]
+      weights = [weight for _, weight in self.mix]
+      interval = self.workers / self.rate if self.rate else 0 # Seconds between this worker's calls
+      next_start = time.perf_counter()
+      while time.perf_counter() < stop_at:
+         if interval:
+            delay = next_start - time.perf_counter()
+            if delay > 0:
+               time.sleep(delay)
+            next_start += interval
+         operation = rng.choices(operations, weights)[0]
+         start = time.perf_counter()
+         try:
+            result = self.run_operation(operation, rng)
+         except Exception as error: # Keep the run going, but report it
+            with self.stats_lock:
+               self.errors.append(f"{operation}: {error!r}")
+            continue
+         elapsed = time.perf_counter() - start
+         with self.stats_lock:
+            self.histograms[operation].record(elapsed)
+            if not result:
+               self.failures[operation] += 1
+
+   def snapshot(self):
+      with self.stats_lock:
+         return {name: (histogram.count, histogram.percentile(50), histogram.percentile(99))
+                 for name, histogram in self.histograms.items()}
+
+   def run(self, duration, report_every=10, directory=None, out=print):
+      # Run for duration seconds, printing a progress line every report_every seconds
+      storage = self.system_options.get("storage") or FileStorage(directory or tempfile.mkdtemp(prefix="ars_load_"))
+      self.seed_schedule(storage)
+      self.system = ReservationSystem(**dict(self.system_options, storage=storage))
+      start_size = data_size(storage)
+      start = time.perf_counter()
+      stop_at = start + duration
+      threads = [threading.Thread(target=self.worker, args=(i, stop_at), daemon=True) for i in range(self.workers)]
+      for thread in threads:
+         thread.start()
+      samples = []
+      last_count, last_elapsed = 0, 0.0
+      next_report = start + report_every
+      while any(thread.is_alive() for thread in threads):
+         for thread in threads:
+            thread.join(timeout=max(next_report - time.perf_counter(), 0))
+         next_report += report_every
+         elapsed = time.perf_counter() - start
+         stats = self.snapshot()
+         count = sum(value[0] for value in stats.values())
+         size = data_size(storage)
+         throughput = (count - last_count) / (elapsed - last_elapsed) if elapsed > last_elapsed else 0.0
+         samples.append({"elapsed": round(elapsed, 1), "ops": count, "throughput": round(throughput, 1),
+                         "bytes": size, "bookings": len(self.system.bookings)})
+         last_count, last_elapsed = count, elapsed
+         out(f"[{elapsed:7.1f}s] ops={count:<8} ops/s={samples[-1]['throughput']:<9} data={size / 1024:.1f} KiB "
+             f"bookings={len(self.system.bookings)} "
+             + " ".join(f"{name}:p50={p50 * 1000:.2f}ms/p99={p99 * 1000:.2f}ms" for name, (n, p50, p99) in stats.items() if n))
+      total = time.perf_counter() - start
+      return self.summary(total, start_size, data_size(storage), samples)
+
+   def summary(self, total, start_size, end_size, samples):
+      operations = {}
+      for name, histogram in self.histograms.items():
+         if histogram.count:
+            operations[name] = {"count": histogram.count, "failed": self.failures[name],
+                                "p50_ms": histogram.percentile(50) * 1000, "p99_ms": histogram.percentile(99) * 1000,
+                                "max_ms": histogram.max * 1000}
+      count = sum(histogram.count for histogram in self.histograms.values())
+      return {"seconds": total, "operations": count, "throughput": count / total if total else 0.0,
+              "start_bytes": start_size, "end_bytes": end_size, "by_operation": operations,
+              "samples": samples, "errors": self.errors[:20], "error_count": len(self.errors)}
+
+# Run a recorded trace against a fresh store (optionally starting from the files in data_dir).
+# speed 1 keeps the recorded gaps between operations, 2 halves them, 0 runs as fast as possible.
+def replay_trace(path, speed=1.0, data_dir=None, directory=None, system_options=None):
+   with open(path, "r") as f:
+      entries = [json.loads(line) for line in f if line.strip()]
+   options = dict(system_options or {})
+   storage = options.setdefault("storage", FileStorage(directory or tempfile.mkdtemp(prefix="ars_replay_")))
+   if data_dir:
+      for file_name in ("flights.json", "bookings.json", "waitlists.jsonl"):
+         if os.path.exists(os.path.join(data_dir, file_name)):
+            with open(os.path.join(data_dir, file_name), "r") as f:
+               storage.write_lines(file_name, [f.read()])
+   system = ReservationSystem(**options)
+   histograms = {}
+   mismatches = [] # Operations whose outcome differs from the recording
+   hold_ids = {} # Recorded hold id -> the id the replay got for the same hold
+   first = entries[0]["ts"] if entries else 0.0
+   start = time.perf_counter()
+   for entry in entries:
+      if speed:
+         delay = (entry["ts"] - first) / speed - (time.perf_counter() - start)
+         if delay > 0:
+            time.sleep(delay)
+      args, kwargs = list(entry["args"]), dict(entry.get("kwargs", {}))
+      if entry["op"] in ("confirm_hold", "release_hold"):
+         if args:
+            args[0] = hold_ids.get(args[0], args[0])
+         elif "hold_id" in kwargs:
+            kwargs["hold_id"] = hold_ids.get(kwargs["hold_id"], kwargs["hold_id"])
+      call_start = time.perf_counter()
+      try:
+         outcome = trace_outcome(getattr(system, entry["op"])(*args, **kwargs))
+      except Exception as error:
+         outcome = trace_outcome(None, error)
+      histograms.setdefault(entry["op"], LatencyHistogram()).record(time.perf_counter() - call_start)
+      if entry["op"] == "hold_seat" and isinstance(outcome, int) and isinstance(entry["outcome"], int):
+         hold_ids[entry["outcome"]] = outcome
+         outcome = entry["outcome"] # Hold ids are numbered per run, only whether one was given matters
+      elif entry["op"] == "expire_holds" and isinstance(outcome, list):
+         recorded_ids = {replayed: recorded for recorded, replayed in hold_ids.items()}
+         outcome = [recorded_ids.get(hold_id, hold_id) for hold_id in outcome]
+      if outcome != entry["outcome"]:
+         mismatches.append({"op": entry["op"], "args": entry["args"], "recorded": entry["outcome"], "replayed": outcome})
+   total = time.perf_counter() - start
+   operations = {name: {"count": histogram.count, "p50_ms": histogram.percentile(50) * 1000,
+                        "p99_ms": histogram.percentile(99) * 1000, "max_ms": histogram.max * 1000,
+                        "recorded_p50_ms": sorted(e["ms"] for e in entries if e["op"] == name)[histogram.count // 2]}
+                 for name, histogram in histograms.items()}
+   return {"seconds": total, "operations": len(entries), "throughput": len(entries) / total if total else 0.0,
+           "by_operation": operations, "mismatches": mismatches[:20], "mismatch_count": len(mismatches)}
+
+def print_replay(result):
+   print(f"{result['operations']} operations replayed in {result['seconds']:.2f}s = {result['throughput']:.1f} ops/s, "
+         f"{result['mismatch_count']} outcomes differ from the recording")
+   for name, stats in result["by_operation"].items():
+      print(f"  {name:<27} n={stats['count']:<7} p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms "
+            f"max={stats['max_ms']:.2f}ms (recorded p50={stats['recorded_p50_ms']:.2f}ms)")
+   for mismatch in result["mismatches"]:
+      print(f"  differs: {mismatch}")
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Load / soak test for the reservation system")
+   parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+   parser.add_argument("--workers", type=int, default=4, help="simulated counters running at once")
+   parser.add_argument("--rate", type=float, default=0, help="total operations per second (0 = as fast as possible)")
+   parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+   parser.add_argument("--passengers", type=int, default=5000, help="size of the passenger name pool")
+   parser.add_argument("--flights", type=int, default=50, help="flights in the schedule at the start")
+   parser.add_argument("--report-every", type=float, default=10, help="seconds between progress lines")
+   parser.add_argument("--shared", action="store_true", help="use shared mode (file lock + mutation log)")
+   parser.add_argument("--shards", type=int, help="use the sharded booking store with this many shards (parallel shard writes need no --shared)")
+   parser.add_argument("--binary", action="store_true", help="use the memory-mapped binary booking store")
+   parser.add_argument("--memory", action="store_true", help="keep the data files in memory (no disk I/O)")
+   parser.add_argument("--seed", type=int, help="random seed for a repeatable run")
+   parser.add_argument("--keep", action="store_true", help="keep the data folder instead of deleting it")
+   parser.add_argument("--json", metavar="PATH", help="also write the summary as JSON")
+   parser.add_argument("--replay", metavar="TRACE", help="replay a recorded trace instead of the random mix")
+   parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor (1 = as recorded)")
+   parser.add_argument("--fast", action="store_true", help="replay as fast as possible")
+   parser.add_argument("--data", metavar="DIR", help="folder with the data files to start the replay from")
+   args = parser.parse_args(argv)
+
+   options = {"shared": args.shared, "booking_shards": args.shards, "binary_bookings": args.binary}
+   if args.memory:
+      options["storage"] = MemoryStorage()
+   if args.replay:
+      directory = tempfile.mkdtemp(prefix="ars_replay_")
+      try:
+         result = replay_trace(args.replay, 0 if args.fast else args.speed, args.data, directory, options)
+      finally:
+         shutil.rmtree(directory, ignore_errors=True)
+      print_replay(result)
+      if args.json:
+         with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+      return
+   test = LoadTest(parse_mix(args.mix), args.workers, args.rate, args.passengers, args.flights, args.seed, options)
+   directory = tempfile.mkdtemp(prefix="ars_load_")
+   try:
+      result = test.run(args.duration, args.report_every, directory)
+   finally:
+      if args.keep:
+         print(f"Data kept in {directory}")
+      else:
+         shutil.rmtree(directory, ignore_errors=True)
+   print(f"\n{result['operations']} operations in {result['seconds']:.1f}s = {result['throughput']:.1f} ops/s, "
+         f"data {result['start_bytes'] / 1024:.1f} -> {result['end_bytes'] / 1024:.1f} KiB, errors: {result['error_count']}")
+   for name, stats in result["by_operation"].items():
+      print(f"  {name:<14} n={stats['count']:<8} failed={stats['failed']:<7} p50={stats['p50_ms']:.2f}ms "
+            f"p99={stats['p99_ms']:.2f}ms max={stats['max_ms']:.2f}ms")
+   for error in result["errors"]:
+      print(f"  error: {error}")
+   if args.json:
+      with open(args.json, "w") as f:
+         json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+   main()
@@ -1,9 +1,16 @@
-from ArlineCode import ReservationSystem
+import json
+import zipfile
+import threading
+import time
+from datetime import datetime
+import pytest
+from AirlineCode import ReservationSystem, Profiler, ReadOnlyError, MemoryStorage, LRUCache, BinaryBookingStore
+from load_test import LoadTest, parse_mix, replay_trace
 
 # Set up the system globally for all tests
 def setup_function():
     global rs
-    rs = ReservationSystem()
+    rs = ReservationSystem(storage=MemoryStorage())  # Nothing on disk, so tests can't see each other's data
 
 # Test booking a valid flight
 def test_book_valid_flight():
@@ -26,4 +33,629 @@ def test_cancel_existing_booking():
 # Test canceling a booking that doesn't exist
 def test_cancel_nonexistent_booking():
     result = rs.cancel_booking("Charlie")  # Charlie never booked
-    assert result is False  # Cancel should fail
\ No newline at end of file
+    assert result is False  # Cancel should fail
+
+# Repeated lookups come from the cache and booking again invalidates it
+def test_view_booking_cache():
+    system = ReservationSystem(storage=MemoryStorage())
+    system.book_flight("Amir", "LA123")
+    assert system.view_booking("Amir").code == "LA123"
+    assert system.view_booking("Amir").code == "LA123"
+    assert system.cache_stats()["lookups"]["hits"] == 1
+    system.book_flight("Amir", "TX456")  # Changing the booking must not serve the old flight
+    assert system.view_booking("Amir").code == "TX456"
+    system.cancel_booking("Amir")
+    assert system.view_booking("Amir") is None
+
+
+# Sharded storage keeps bookings across restarts and after changing the shard count
+def test_sharded_bookings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(booking_shards=4)
+    system.book_flight("Amir", "LA123")
+    system.book_flight("Jeff", "TX456")
+    system.book_flight("Amir", "NY789")  # Moves Amir to another shard
+    system.cancel_booking("Jeff")
+    assert ReservationSystem(booking_shards=4).bookings == {"Amir": "NY789"}
+    assert ReservationSystem(booking_shards=2).bookings == {"Amir": "NY789"}  # Rebalanced on load
+    assert not (tmp_path / "booking_shards" / "shard_003.jsonl").exists()
+
+
+# A held seat counts against capacity until it is confirmed or expires
+def test_seat_hold_and_expiry():
+    system = ReservationSystem(storage=MemoryStorage())
+    system.get_flight("LA123").capacity = 1
+    now = time.monotonic()
+    hold_id = system.hold_seat("Amir", "LA123", ttl=60, now=now)
+    assert hold_id is not None
+    assert system.hold_seat("Jeff", "LA123", now=now) is None  # Last seat is held
+    assert system.book_flight("Jeff", "LA123") is None
+    assert system.expire_holds(now + 61) == [hold_id]
+    assert system.confirm_hold(hold_id) is None  # Too late
+    assert system.book_flight("Jeff", "LA123").code == "LA123"
+
+
+# Cancelling a booking on a full flight promotes the highest priority waiting passenger
+def test_waitlist_promotion():
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.get_flight("LA123").capacity = 1
+    system.book_flight("Amir", "LA123")
+    assert system.join_waitlist("Jeff", "LA123") == 1
+    assert system.join_waitlist("Jake", "LA123", priority=5) == 1  # Jumps ahead of Jeff
+    assert system.waitlist_position("Jeff", "LA123") == 2
+    system.cancel_booking("Amir")
+    assert system.bookings["Jake"] == "LA123"
+    assert ReservationSystem(storage=storage).waitlist_position("Jeff", "LA123") == 1  # Waitlist was saved
+
+
+# Places in line stay right as people join, leave and get seats, and the live count follows them
+def test_waitlist_positions_and_count():
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.get_flight("LA123").capacity = 1
+    system.book_flight("Amir", "LA123")
+    for name in ["Jeff", "Jake", "Sara", "Omar"]:
+        system.join_waitlist(name, "LA123")
+    assert system.join_waitlist("Lina", "LA123", priority=2) == 1
+    assert system.leave_waitlist("Jake", "LA123")
+    assert [system.waitlist_position(name, "LA123") for name in ["Lina", "Jeff", "Sara", "Omar"]] == [1, 2, 3, 4]
+    assert system.waitlist_position("Jake", "LA123") is None
+    system.cancel_booking("Amir")  # Lina gets the seat
+    assert system.waitlist_position("Sara", "LA123") == 2
+    assert system.waitlisted == 3
+    assert ReservationSystem(storage=storage).waitlisted == 3
+
+
+# Cancelling a booked flight moves its passengers to the next flights to the same place
+def test_cancel_flight_rebooks_passengers():
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.add_flight("LA200", "Los Angeles", "2025-05-02 09:00").capacity = 1
+    system.add_flight("LA300", "Los Angeles", "2025-05-03 09:00")
+    system.book_flight("Amir", "LA123")
+    system.book_flight("Jeff", "LA123")
+    result = system.cancel_flight("LA123")
+    assert result["rebooked"] == {"Amir": "LA200", "Jeff": "LA300"}
+    assert system.get_flight("LA123") is None
+    assert ReservationSystem(storage=storage).bookings == {"Amir": "LA200", "Jeff": "LA300"}
+
+
+# Passengers moved to a waitlist by a cancelled flight survive a crash half way through saving
+def test_cancel_flight_recovers_waitlist(monkeypatch):
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.add_flight("LA200", "Los Angeles", "2025-05-02 09:00").capacity = 1
+    system.book_flight("Amir", "LA123")
+    system.book_flight("Jeff", "LA123")
+    def crash():
+        raise RuntimeError("crash")
+    monkeypatch.setattr(system, "save_bookings", crash)
+    with pytest.raises(RuntimeError):
+        system.cancel_flight("LA123")
+    recovered = ReservationSystem(storage=storage)
+    assert recovered.bookings == {"Amir": "LA200"}
+    assert recovered.waitlist_position("Jeff", "LA200") == 1
+    assert ReservationSystem(storage=storage).waitlist_position("Jeff", "LA200") == 1  # Written to the waitlist log too
+
+
+# Metrics only record while enabled and export in Prometheus format
+def test_metrics_registry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem()
+    system.book_flight("Amir", "LA123")
+    assert system.metrics.snapshot()["latency_seconds"] == {}  # Off by default
+    system.metrics.enabled = True
+    system.book_flight("Jeff", "LA123")
+    system.view_booking("Jeff")
+    stats = system.metrics.snapshot()["latency_seconds"]
+    assert stats["book_flight"]["count"] == 1
+    assert stats["view_booking"]["count"] == 1
+    assert "lock_wait" in stats
+    system.metrics.export("metrics.prom")
+    assert 'ars_book_flight_seconds_bucket{le="+Inf"} 1' in (tmp_path / "metrics.prom").read_text()
+
+
+# The profiler keeps a profile per handler and logs calls over the threshold
+def test_profiler_logs_slow_calls(tmp_path):
+    profiler = Profiler(slow_ms=-1, directory=str(tmp_path / "profiles"), log_path=str(tmp_path / "slow.log"))
+    assert profiler.run("sum", sum, range(1000)) == 499500
+    profiler.dump()
+    assert (tmp_path / "profiles" / "sum.prof").exists()
+    assert "slow handler sum" in (tmp_path / "slow.log").read_text()
+
+
+# The system publishes a typed event for every change
+def test_change_events():
+    system = ReservationSystem(storage=MemoryStorage())
+    events = []
+    system.events.subscribe(None, events.append)
+    system.book_flight("Amir", "LA123")
+    system.book_flight("Amir", "TX456")
+    system.cancel_booking("Amir")
+    system.delete_flight("NY789")
+    assert [type(event).__name__ for event in events] == [
+        "BookingCreated", "BookingCancelled", "BookingCreated", "BookingCancelled", "FlightDeleted"]
+
+
+# Two systems sharing the same files see each other's changes instead of overwriting them
+def test_shared_store_between_instances(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = ReservationSystem(shared=True)
+    second = ReservationSystem(shared=True)
+    first.book_flight("Amir", "LA123")
+    assert second.view_booking("Amir").code == "LA123"
+    second.book_flight("Jeff", "TX456")
+    second.add_flight("HW1", "Hawaii", "2030-01-01 09:00")
+    first.cancel_booking("Amir")
+    assert first.bookings == {"Jeff": "TX456"}
+    assert first.get_flight("HW1") is not None
+    assert second.view_booking("Amir") is None
+    assert ReservationSystem().bookings == {"Jeff": "TX456"}  # Files hold both processes' changes
+
+
+# Flights that already left move to compressed monthly segments that can still be searched
+def test_archive_departed_flights(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem()
+    system.add_flight("FUT1", "Texas", "2099-01-01 08:00")
+    system.book_flight("Amir", "LA123")
+    system.book_flight("Jeff", "FUT1")
+    assert system.archive_departed() == 3
+    assert [flight.code for flight in system.flights] == ["FUT1"]
+    assert system.bookings == {"Jeff": "FUT1"}
+    assert (tmp_path / "archive" / "2025-05.jsonl.gz").exists()
+    assert system.query_archive(name="Amir") == [{"type": "booking", "name": "Amir", "code": "LA123"}]
+    assert len(system.query_archive(code="TX456")) == 1
+
+
+# A snapshot plus the mutation log brings the data back to any earlier moment
+def test_snapshot_point_in_time_restore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(snapshot_interval=3600)
+    system.book_flight("Amir", "LA123")
+    time.sleep(0.01)
+    before_mistake = time.time()
+    time.sleep(0.01)
+    system.cancel_booking("Amir")
+    system.delete_flight("NY789")
+    assert system.restore_to(before_mistake)
+    assert system.bookings == {"Amir": "LA123"}
+    assert system.get_flight("NY789") is not None
+    assert ReservationSystem().bookings == {"Amir": "LA123"}  # Files were restored too
+
+
+# The mutation log is trimmed below the oldest kept snapshot; other processes and restores still work
+def test_mutation_log_trim(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    writer = ReservationSystem(snapshot_interval=0)  # A snapshot after every change
+    writer.snapshots.keep = 2
+    reader = ReservationSystem(shared=True)
+    for i in range(30):
+        writer.book_flight(f"P{i}", "LA123")
+    writer.snapshots.wait()
+    with open("mutations.jsonl") as f:
+        assert f.readline().startswith('{"base"')
+        assert len(f.readlines()) < 30
+    reader.sync()
+    assert reader.bookings == writer.bookings
+    assert ReservationSystem(shared=True).mutation_log.generation == writer.mutation_log.generation
+    before = time.time()
+    time.sleep(0.01)
+    writer.cancel_booking("P29")
+    reader.sync()
+    assert "P29" not in reader.bookings
+    assert writer.restore_to(before)
+    assert writer.bookings["P29"] == "LA123"
+
+
+# Fares come from a precomputed table that only changes when the load factor bucket changes
+def test_fare_quotes():
+    system = ReservationSystem(storage=MemoryStorage())
+    flight = system.add_flight("FUT1", "Texas", "2030-01-31 10:00")
+    flight.capacity = 4
+    now = datetime(2030, 1, 1)
+    assert system.quote_fare("FUT1", now=now) == 120.0  # 30 days out, empty flight
+    assert system.quote_fare("FUT1", "business", now=now) == 300.0
+    assert system.quote_fare("FUT1", now=datetime(2030, 1, 31)) == 216.0  # Leaves today
+    built = system.fares.tables_built
+    system.book_flight("Amir", "FUT1")  # 25% full, same bucket
+    assert system.fares.tables_built == built
+    system.book_flight("Jeff", "FUT1")
+    system.book_flight("Jake", "FUT1")  # 75% full
+    assert system.quote_fare("FUT1", now=now) == 150.0
+    assert system.quote_fares(["FUT1", "NOPE"], now=now) == {"FUT1": 150.0, "NOPE": None}
+
+
+# Mistyped names still find the closest booked passengers
+def test_fuzzy_passenger_search():
+    system = ReservationSystem(storage=MemoryStorage())
+    for name in ["Amir Shabo", "Amy Shaw", "Jeff Jones", "Jake Smith"]:
+        system.book_flight(name, "LA123")
+    assert system.find_passengers("Amir Shbo")[0] == "Amir Shabo"
+    assert system.find_passengers("jef jones", limit=1) == ["Jeff Jones"]
+    system.book_flight("Jeff Jones", "TX456")  # Moving flights keeps the name searchable
+    assert system.find_passengers("Jeff Jones", limit=1) == ["Jeff Jones"]
+    system.cancel_booking("Amir Shabo")
+    assert "Amir Shabo" not in system.find_passengers("Amir Shbo")
+
+
+# A short load run books, views and cancels from several threads without errors
+def test_load_harness(tmp_path):
+    test = LoadTest(parse_mix("book=5,view=3,cancel=2,add_flight=1,delete_flight=1"), workers=3, passengers=50, flights=5, seed=1)
+    result = test.run(0.5, report_every=0.25, directory=str(tmp_path), out=lambda line: None)
+    assert result["error_count"] == 0
+    assert result["operations"] == sum(op["count"] for op in result["by_operation"].values()) > 0
+    assert result["end_bytes"] > result["start_bytes"]
+    assert len(result["samples"]) >= 2
+
+
+# The binary store imports bookings.json once, then changes records in place across restarts
+def test_binary_booking_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "bookings.json").write_text('{"Amir": "LA123", "Jeff": "TX456"}')
+    system = ReservationSystem(binary_bookings=True)
+    assert system.view_booking("Amir").code == "LA123"
+    assert system.cancel_booking("Amir")
+    system.book_flight("Jake", "TX456")
+    system.book_flight("Amir", "TX456")  # Reuses the cancelled record
+    reopened = ReservationSystem(binary_bookings=True)
+    assert dict(reopened.bookings) == {"Jeff": "TX456", "Jake": "TX456", "Amir": "TX456"}
+    assert reopened.booked_count("TX456") == 3 and reopened.bookings.used == 3
+    assert reopened._flight_passengers is None  # Counting seats didn't need the passenger index
+
+
+# Names written since the last flush can be read back right away
+def test_binary_store_reads_before_flush(tmp_path):
+    store = BinaryBookingStore(str(tmp_path / "bookings")).open()
+    store["Amir"] = "LA123"
+    store["Jeff"] = "TX456"
+    store["Jake"] = "LA123"
+    assert sorted(store.items()) == [("Amir", "LA123"), ("Jake", "LA123"), ("Jeff", "TX456")]
+    store.close()
+
+
+# Bookings are saved as encoding tables plus ids, and old name -> code files still load
+def test_encoded_bookings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "bookings.json").write_text('{"Amir": "LA123", "Jeff": "TX456"}')
+    system = ReservationSystem()
+    system.book_flight("Jake", "LA123")
+    system.cancel_booking("Jeff")
+    saved = json.loads((tmp_path / "bookings.json").read_text())
+    assert saved["passengers"] == ["Amir", "Jake"]
+    assert [saved["flights"][flight] for flight in saved["bookings"]] == ["LA123", "LA123"]
+    reopened = ReservationSystem()
+    assert reopened.bookings == {"Amir": "LA123", "Jake": "LA123"}
+    assert sorted(reopened.passengers_on("LA123")) == ["Amir", "Jake"]
+    assert reopened.booked_count("TX456") == 0
+
+
+# A recorded trace replays against a fresh store with the same outcomes
+def test_trace_record_and_replay(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(trace="trace.jsonl")
+    system.add_flight("FUT1", "Texas", "2030-01-01 10:00")
+    system.book_flight("Amir", "FUT1")
+    system.view_booking("Amir")
+    system.cancel_booking("Nobody")
+    system.get_all_bookings_report()
+    system.trace.close()
+    entries = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    assert [entry["op"] for entry in entries] == ["add_flight", "book_flight", "view_booking", "cancel_booking", "get_all_bookings_report"]
+    assert entries[1]["args"] == ["Amir", "FUT1"] and entries[1]["outcome"] == "FUT1"
+    result = replay_trace(str(tmp_path / "trace.jsonl"), speed=0, directory=str(tmp_path / "replay"))
+    assert result["operations"] == 5 and result["mismatch_count"] == 0
+
+
+# Holds, waitlists and schedules are traced too, and hold ids from the recording map to the replayed ones
+def test_trace_replays_holds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(trace="trace.jsonl")
+    next(system.hold_ids)  # The replay numbers its holds differently
+    hold_id = system.hold_seat("Amir", "LA123")
+    system.confirm_hold(hold_id)
+    system.view_booking("Amir")
+    system.release_hold(system.hold_seat("Jeff", "TX456"))
+    system.join_waitlist("Jake", "LA123")
+    system.leave_waitlist("Jake", "LA123")
+    system.add_schedule("DLY", "Texas", "10:00", "2030-01-01", "2030-01-31")
+    system.delete_flight("TX456")
+    system.trace.close()
+    entries = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    assert [entry["op"] for entry in entries] == ["hold_seat", "confirm_hold", "view_booking", "hold_seat", "release_hold",
+                                                 "join_waitlist", "leave_waitlist", "add_schedule", "delete_flight"]
+    result = replay_trace(str(tmp_path / "trace.jsonl"), speed=0, directory=str(tmp_path / "replay"))
+    assert result["mismatch_count"] == 0
+
+
+# Traces and manifests written by default go into the data folder, not the working folder
+def test_output_files_in_data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(trace=True, data_dir="data")
+    system.book_flight("Amir", "LA123")
+    system.trace.close()
+    system.write_manifests()
+    assert (tmp_path / "data" / "request_trace.jsonl").exists()
+    assert (tmp_path / "data" / "manifests" / "LA123.csv").exists()
+    assert not (tmp_path / "request_trace.jsonl").exists()
+
+
+# A daily rule offers departures without saving them until one is booked
+def test_schedule_rules():
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.add_schedule("DLY", "Texas", "10:00", "2030-01-01", "2030-12-31", exceptions=["2030-01-03"])
+    assert len(system.flights) == 3 and system.get_flight("DLY-20300102").date_time == "2030-01-02 10:00"
+    assert system.get_flight("DLY-20300103") is None  # Holiday
+    upcoming = [f.code for f in system.bookable_flights(now=datetime(2030, 1, 1), days=4)][3:]
+    assert upcoming == ["DLY-20300101", "DLY-20300102", "DLY-20300104", "DLY-20300105"]
+    system.book_flight("Amir", "DLY-20300102")
+    assert [f.code for f in system.flights][3:] == ["DLY-20300102"]  # Only the booked day is saved
+    assert system.delete_flight("DLY-20300104")
+    reopened = ReservationSystem(storage=storage)
+    assert reopened.view_booking("Amir").date_time == "2030-01-02 10:00"
+    assert reopened.get_flight("DLY-20300104") is None and reopened.get_flight("DLY-20301231")
+
+
+# Queries use the most selective index and say which one in explain()
+def test_flight_query_planner():
+    system = ReservationSystem(storage=MemoryStorage())
+    for day in range(1, 21):
+        system.add_flight(f"P{day}", "Paris" if day % 2 else "Rome", f"2030-03-{day:02d} 09:00")
+    system.book_flight("Amir", "P3")
+    query = system.query().to("Paris").departing(after="2030-03-02", before="2030-03-09").order_by("departure").limit(2)
+    assert [flight.code for flight in query] == ["P3", "P5"]
+    assert "index: departure index (Paris) (4 of 23 flights)" in query.explain()
+    assert "streamed" in query.explain()
+    assert [flight.code for flight in system.query().booked_by("Amir")] == ["P3"]
+    assert system.query().booked_by("Amir").explain().startswith("index: passenger booking")
+    busiest = system.query().to("Paris").order_by("seats").limit(1).all()
+    assert [flight.code for flight in busiest] == ["P3"]
+
+
+# A replica follows the primary's mutation log and refuses to change anything
+def test_read_only_replica(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    primary = ReservationSystem(shared=True)
+    primary.book_flight("Amir", "LA123")
+    replica = ReservationSystem(replica=True)
+    assert replica.view_booking("Amir").code == "LA123"
+    primary.book_flight("Jeff", "TX456")
+    primary.cancel_booking("Amir")
+    assert replica.lag() > 0
+    assert replica.get_all_bookings_report() == "Passenger: Jeff, Flight: TX456: Texas at 2025-05-02 14:30"
+    assert replica.lag() == 0
+    with pytest.raises(ReadOnlyError):
+        replica.book_flight("Jake", "NY789")
+    replica.follow(interval=0.01)
+    primary.book_flight("Jake", "NY789")
+    deadline = time.time() + 2
+    while replica.bookings.get("Jake") is None and time.time() < deadline:
+        time.sleep(0.01)
+    replica.stop_following()
+    assert replica.bookings.get("Jake") == "NY789"
+
+
+# A replica frees the seat of a replayed hold once it runs out, without writing anything
+def test_replica_expires_holds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    primary = ReservationSystem(shared=True)
+    primary.get_flight("LA123").capacity = 1
+    primary.save_flights()
+    replica = ReservationSystem(replica=True)
+    primary.hold_seat("Amir", "LA123", ttl=0.2)
+    replica.sync()
+    assert replica.seats_left("LA123") == 0
+    time.sleep(0.3)
+    assert replica.seats_left("LA123") == 1
+    assert replica.holds == {}
+
+
+# A flights.json dropped in from outside is applied as a diff without a restart
+def test_flights_file_hot_reload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "flights.json").write_text(json.dumps([
+        {"code": "A1", "destination": "Rome", "date_time": "2030-01-01 10:00"},
+        {"code": "A2", "destination": "Rome", "date_time": "2030-01-02 10:00"},
+        {"code": "A3", "destination": "Oslo", "date_time": "2030-01-03 10:00"}]))
+    system = ReservationSystem()
+    system.book_flight("Amir", "A1")
+    seen = []
+    system.events.subscribe(None, seen.append)
+    assert system.check_flights_file() is None  # Our own write doesn't count
+    (tmp_path / "flights.json").write_text(json.dumps([
+        {"code": "A2", "destination": "Rome", "date_time": "2030-01-02 12:00"},
+        {"code": "A4", "destination": "Oslo", "date_time": "2030-01-04 10:00"}]))
+    assert system.check_flights_file() == {"added": ["A4"], "changed": ["A2"], "removed": ["A1", "A3"]}
+    assert [type(event).__name__ for event in seen].count("DataReloaded") == 0  # Only per-flight events
+    assert system.get_flight("A2").date_time == "2030-01-02 12:00"
+    assert system.bookings["Amir"] == "A2"  # Moved off the removed flight
+    assert system.check_flights_file() is None
+    assert sorted(f["code"] for f in json.loads((tmp_path / "flights.json").read_text())) == ["A2", "A4"]
+
+
+# Manifests: one CSV per flight, a departure window, or a single zip
+def test_passenger_manifests(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "flights.json").write_text(json.dumps([
+        {"code": "A1", "destination": "Rome", "date_time": "2030-01-01 10:00"},
+        {"code": "A2", "destination": "Oslo", "date_time": "2030-01-03 10:00"}]))
+    system = ReservationSystem()
+    system.book_flight("Zoe", "A1")
+    system.book_flight("Amir", "A1")
+    paths = system.write_manifests("out")
+    assert sorted(p.rsplit("/", 1)[-1] for p in paths) == ["A1.csv", "A2.csv"]
+    lines = (tmp_path / "out" / "A1.csv").read_text().splitlines()
+    assert lines[:4] == ["flight,A1", "destination,Rome", "departure,2030-01-01 10:00", "passengers,2"]
+    assert lines[-2:] == ["Amir", "Zoe"]
+    soon = system.write_manifests("soon", within_hours=24, now=datetime(2030, 1, 1, 0, 0))
+    assert [p.rsplit("/", 1)[-1] for p in soon] == ["A1.csv"]
+    [archive] = system.write_manifests("zipped", combined=True, now=datetime(2030, 1, 1, 0, 0))
+    with zipfile.ZipFile(archive) as z:
+        assert sorted(z.namelist()) == ["A1.csv", "A2.csv"]
+
+
+# Data files go to the chosen folder, and the in-memory backend keeps them off the disk entirely
+def test_data_dir_and_memory_storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = ReservationSystem(data_dir=str(tmp_path / "data"))
+    system.book_flight("Amir", "LA123")
+    assert ReservationSystem(data_dir=str(tmp_path / "data")).bookings == {"Amir": "LA123"}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["data"]
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    system.book_flight("Amir", "TX456")
+    system.join_waitlist("Jeff", "TX456")
+    assert ReservationSystem(storage=storage).bookings == {"Amir": "TX456"}
+    assert ReservationSystem(storage=storage).waitlist_position("Jeff", "TX456") == 1
+    assert sorted(storage.files) == ["bookings.json", "flights.json", "integrity.json", "waitlists.jsonl"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["data"]
+    with pytest.raises(ValueError):
+        ReservationSystem(storage=MemoryStorage(), shared=True)  # Needs real files
+
+
+# Integrity check finds bad data and afterwards only verifies the segments that changed
+def test_integrity_check():
+    storage = MemoryStorage()
+    storage.write_json("flights.json", [
+        {"code": "A1", "destination": "Rome", "date_time": "2030-01-01 10:00", "capacity": 1},
+        {"code": "A2", "destination": "Rome", "date_time": "someday"},
+        {"code": "A2", "destination": "Oslo", "date_time": "2030-01-02 10:00"}])
+    storage.write_json("bookings.json", {"Amir": "A1", "Jeff": "A1", "Jake": "GONE"})
+    system = ReservationSystem(storage=storage)
+    assert sorted(problem["type"] for problem in system.integrity_problems) == [
+        "bad_date_time", "duplicate_flight", "orphan_booking", "over_capacity"]
+    reopened = ReservationSystem(storage=storage)  # Files unchanged: nothing is verified again
+    assert reopened.integrity.segments_checked == 0 and reopened.integrity_problems == system.integrity_problems
+    reopened.cancel_booking("Jeff")
+    reopened.cancel_booking("Jake")  # Back within capacity, orphan gone
+    assert reopened.check_integrity() == [problem for problem in system.integrity_problems if problem["code"] == "A2"]
+    assert reopened.integrity.segments_checked == 2  # Segments of A1 and GONE only
+    assert ReservationSystem(storage=storage).integrity.segments_checked == 0
+    assert len(reopened.check_integrity(full=True)) == 2
+
+
+# A slow write to one booking shard doesn't hold up bookings on other shards
+def test_sharded_writes_run_in_parallel(tmp_path):
+    system = ReservationSystem(booking_shards=4, data_dir=str(tmp_path))
+    store = system.shard_store
+    slow_code, fast_code = "LA123", next(f.code for f in system.flights if store.shard_for(f.code) != store.shard_for("LA123"))
+    entered, gate = threading.Event(), threading.Event()
+    original = store._flush_shard
+    def slow_flush(index):
+        if threading.current_thread().name == "slow":
+            entered.set()
+            gate.wait(5)
+        original(index)
+    store._flush_shard = slow_flush
+    slow = threading.Thread(target=system.book_flight, args=("Amir", slow_code), name="slow")
+    slow.start()
+    assert entered.wait(5)
+    fast = threading.Thread(target=system.book_flight, args=("Jeff", fast_code))
+    fast.start()
+    fast.join(2)
+    finished = not fast.is_alive()
+    gate.set()
+    slow.join()
+    assert finished  # Didn't wait for the other shard's write
+    assert ReservationSystem(booking_shards=4, data_dir=str(tmp_path)).bookings == {"Amir": slow_code, "Jeff": fast_code}
+
+
+# Confirming a hold on another flight gives the passenger's old seat to the waitlist
+def test_confirm_hold_promotes_waitlist():
+    system = ReservationSystem(storage=MemoryStorage())
+    system.get_flight("LA123").capacity = 1
+    system.book_flight("Amir", "LA123")
+    system.join_waitlist("Jeff", "LA123")
+    assert system.confirm_hold(system.hold_seat("Amir", "TX456")).code == "TX456"
+    assert system.bookings["Jeff"] == "LA123"
+    assert system.seats_left("LA123") == 0
+
+
+# A handler that calls another profiled handler is profiled once, as the outer handler
+def test_profiler_nested_handlers(tmp_path):
+    profiler = Profiler(directory=str(tmp_path / "profiles"), log_path=str(tmp_path / "slow.log"))
+    assert profiler.run("outer", lambda: profiler.run("inner", sum, range(10)) + 1) == 46
+    assert sorted(profiler.profiles) == ["outer"]
+
+
+# A shared write from a second thread waits for the file lock instead of skipping it
+def test_shared_write_from_another_thread(tmp_path):
+    system = ReservationSystem(shared=True, data_dir=str(tmp_path))
+    with system.lock, system.process_lock:  # Another thread is inside a shared write
+        system.book_flight("Amir", "LA123")
+        writer = threading.Thread(target=system.book_flight, args=("Jeff", "TX456"))
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()  # Waiting, not writing unlocked
+    writer.join()
+    assert system.pending_mutations == []
+    logged = [json.loads(line)["name"] for line in (tmp_path / "mutations.jsonl").read_text().splitlines()]
+    assert logged == ["Amir", "Jeff"]  # Both reached the log
+
+
+# Shards compacted by one process keep the bookings another process made
+def test_shared_sharded_compaction(tmp_path):
+    first = ReservationSystem(shared=True, booking_shards=1, data_dir=str(tmp_path))
+    second = ReservationSystem(shared=True, booking_shards=1, data_dir=str(tmp_path))
+    first.book_flight("Alice", "LA123")
+    for i in range(80):  # Enough lines for second to compact the shard
+        second.book_flight(f"P{i}", "TX456")
+        second.cancel_booking(f"P{i}")
+    assert ReservationSystem(booking_shards=1, data_dir=str(tmp_path)).bookings == {"Alice": "LA123"}
+
+
+# A seat held at one counter is taken for every other counter sharing the files
+def test_shared_seat_holds(tmp_path):
+    first = ReservationSystem(shared=True, data_dir=str(tmp_path))
+    second = ReservationSystem(shared=True, data_dir=str(tmp_path))
+    first.add_flight("ONE", "Texas", "2030-01-01 10:00").capacity = 1
+    second.sync()
+    second.get_flight("ONE").capacity = 1
+    hold_id = first.hold_seat("Amir", "ONE")
+    assert second.hold_seat("Jeff", "ONE") is None
+    assert second.book_flight("Jeff", "ONE") is None
+    first.release_hold(hold_id)
+    assert second.book_flight("Jeff", "ONE").code == "ONE"
+    assert first.hold_seat("Amir", "ONE") is None
+
+
+# Names and codes that are no longer booked don't pile up in the file or in memory
+def test_encoded_ids_are_compacted():
+    storage = MemoryStorage()
+    system = ReservationSystem(storage=storage)
+    for i in range(3000):
+        system.add_flight(f"T{i}", "Texas", "2030-01-01 10:00")
+        system.book_flight(f"P{i}", f"T{i}")
+        system.cancel_booking(f"P{i}")
+        system.delete_flight(f"T{i}")
+    assert storage.read_json("bookings.json") == {"flights": [], "passengers": [], "bookings": []}
+    assert len(system.passenger_ids) < 1100 and len(system.bookings.flight_of) < 1100
+    system.book_flight("Amir", "LA123")
+    reopened = ReservationSystem(storage=storage)
+    assert len(reopened.flight_ids) == 1 and reopened.bookings == {"Amir": "LA123"}
+    assert reopened.passengers_on("LA123") == ["Amir"]
+
+
+# Lookups on one thread and invalidations on another don't break the cache
+def test_lru_cache_threads():
+    cache = LRUCache(4)
+    errors = []
+    stop = time.time() + 0.5
+    def reader():
+        try:
+            while time.time() < stop:
+                cache.get("k")
+        except Exception as error:
+            errors.append(error)
+    def writer():
+        while time.time() < stop:
+            cache.put("k", 1)
+            cache.invalidate("k")
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []